@@ -0,0 +1,1629 @@
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+from trie import ArrayTrie, MarisaTrie, Trie
+from utils import (
+    _align_entity_spans_sequential,
+    _align_entity_spans_vectorized,
+    _get_end_to_end_prefix_allowed_tokens_fn,
+    _get_entity_spans,
+    get_end_to_end_prefix_allowed_tokens_fn_hf,
+    get_entity_spans_finalize,
+    get_entity_spans_from_tokens,
+    get_entity_spans_post_processing,
+    get_entity_spans_pre_processing,
+    get_input_offset_mappings,
+    batch_it,
+    get_micro_f1,
+    get_offset_mapping,
+    get_paragraph_anchors,
+)
+
+
+def get_synthetic_sequences(
+    num_sequences, vocabulary_length=50265, min_length=2, max_length=12, seed=0
+):
+    rng = random.Random(seed)
+    return [
+        [2]
+        + [
+            rng.randrange(4, vocabulary_length)
+            for _ in range(rng.randint(min_length, max_length))
+        ]
+        + [2]
+        for _ in range(num_sequences)
+    ]
+
+
+def get_prefixes(sequences, num_prefixes, max_prefix_length=3, seed=0):
+    rng = random.Random(seed)
+    prefixes = []
+    for _ in range(num_prefixes):
+        sequence = rng.choice(sequences)
+        prefixes.append(
+            sequence[: rng.randint(0, min(max_prefix_length, len(sequence)))]
+        )
+    return prefixes
+
+
+def time_calls(fn, inputs, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for e in inputs:
+            fn(e)
+        best = min(best, time.perf_counter() - start)
+    return best / len(inputs)
+
+
+def benchmark_marisa_trie_get(num_sequences=100000, num_prefixes=1000, seed=0):
+    sequences = get_synthetic_sequences(num_sequences, seed=seed)
+    prefixes = get_prefixes(sequences, num_prefixes, seed=seed)
+
+    start = time.perf_counter()
+    trie = MarisaTrie(sequences, child_index=True)
+    build_time = time.perf_counter() - start
+
+    for prefix in prefixes:
+        assert sorted(trie.get(prefix)) == sorted(trie._get_from_keys(prefix))
+
+    return {
+        "num_sequences": num_sequences,
+        "build_time": build_time,
+        "keys_scan": time_calls(trie._get_from_keys, prefixes),
+        "child_index": time_calls(trie.get, prefixes),
+    }
+
+
+def benchmark_logits_processor(
+    model, sentences, beam_sizes=(5, 10, 20), **constraints_kwargs
+):
+    results = []
+    for num_beams in beam_sizes:
+        for batched_constraints in (False, True):
+            prefix_allowed_tokens_fn = get_end_to_end_prefix_allowed_tokens_fn_hf(
+                model, sentences, **constraints_kwargs
+            )
+            start = time.perf_counter()
+            outputs = model.sample(
+                sentences,
+                num_beams=num_beams,
+                num_return_sequences=1,
+                prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+                batched_constraints=batched_constraints,
+            )
+            results.append(
+                {
+                    "num_beams": num_beams,
+                    "batched_constraints": batched_constraints,
+                    "sentences_per_second": len(sentences)
+                    / (time.perf_counter() - start),
+                    "outputs": [e[0]["text"] for e in outputs],
+                }
+            )
+
+        assert results[-1]["outputs"] == results[-2]["outputs"]
+
+    return results
+
+
+def benchmark_alignment(model, sentences, num_beams=5, **constraints_kwargs):
+    # differential check of the token aligner against the regex post-processing
+    # and the character alignment of `get_entity_spans_finalize`
+    prefix_allowed_tokens_fn = get_end_to_end_prefix_allowed_tokens_fn_hf(
+        model, get_entity_spans_pre_processing(sentences), **constraints_kwargs
+    )
+    outputs = model.sample(
+        get_entity_spans_pre_processing(sentences),
+        num_beams=num_beams,
+        num_return_sequences=1,
+        prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+    )
+
+    start = time.perf_counter()
+    strings = []
+    for sent, output in zip(sentences, outputs):
+        try:
+            strings += get_entity_spans_finalize(
+                [sent], get_entity_spans_post_processing([output[0]["text"]])
+            )
+        except RuntimeError:
+            strings.append(None)
+    strings_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokens = get_entity_spans_from_tokens(
+        sentences,
+        [e[0]["tokens"] for e in outputs],
+        prefix_allowed_tokens_fn.sent_origs,
+        get_input_offset_mappings(
+            sentences, prefix_allowed_tokens_fn, tokenizer=model.tokenizer
+        ),
+        prefix_allowed_tokens_fn.codes,
+        prefix_allowed_tokens_fn.decode_fn,
+    )
+    tokens_time = time.perf_counter() - start
+
+    return {
+        "num_sentences": len(sentences),
+        "strings_failed": sum(e is None for e in strings),
+        "mismatches": [
+            (sent, e, f)
+            for sent, e, f in zip(sentences, strings, tokens)
+            if e is not None and sorted(tuple(x) for x in e) != sorted(f)
+        ],
+        "strings_time": strings_time,
+        "tokens_time": tokens_time,
+    }
+
+
+def get_synthetic_alignments(num_outputs, max_length=12, seed=0):
+    # sources ([EOS] + tokens + [EOS], as `sent_origs`) and outputs copying them
+    # with `{ mention } [ title ]` inserted, with the spans they encode as
+    # (start, end, title) over source positions. Mentions have one or more
+    # tokens, some are at the first or last token or next to each other; some
+    # outputs are empty, cut before the end (as by `max_length`), or have a
+    # token that is not in the source. Returns (kind, source, output, spans)
+    vocabulary_length = 100
+    rng = random.Random(seed)
+    alignments = []
+    for _ in range(num_outputs):
+        length = rng.randint(1, max_length)
+        source = (
+            [2]
+            + [
+                rng.randrange(_SYNTHETIC_FIRST_TOKEN, vocabulary_length)
+                for _ in range(length)
+            ]
+            + [2]
+        )
+
+        output = [2]
+        spans = []
+        position = 1
+        while position <= length:
+            if rng.random() < 0.4:
+                end = rng.randint(position + 1, length + 1)
+                title = [
+                    rng.randrange(_SYNTHETIC_FIRST_TOKEN, vocabulary_length)
+                    for _ in range(rng.randint(1, 3))
+                ]
+                output += (
+                    [_SYNTHETIC_CODES["{"]]
+                    + source[position:end]
+                    + [_SYNTHETIC_CODES["}"], _SYNTHETIC_CODES["["]]
+                    + title
+                    + [_SYNTHETIC_CODES["]"]]
+                )
+                spans.append((position, end, title, len(output)))
+                position = end
+            else:
+                output.append(source[position])
+                position += 1
+        output.append(2)
+
+        kind = rng.choice(("full", "full", "empty", "cut", "unknown_token"))
+        if kind == "empty":
+            output = rng.choice(([], [2]))
+            spans = []
+        elif kind == "cut":
+            cut = rng.randrange(1, len(output))
+            output = output[:cut]
+            spans = [e for e in spans if e[3] <= cut]
+        elif kind == "unknown_token":
+            # before the first mention, so that it never splits one
+            first = output.index(_SYNTHETIC_CODES["{"]) if spans else len(output)
+            output.insert(rng.randint(1, first), vocabulary_length)
+
+        alignments.append(
+            (
+                kind,
+                source,
+                output,
+                [(start, end, title) for start, end, title, _ in spans],
+            )
+        )
+
+    return alignments
+
+
+def check_alignment(num_outputs=10000, max_length=12, seed=0):
+    # model-free check of the token aligners on synthetic outputs (see
+    # `get_synthetic_alignments`): the vectorized one must find the spans or
+    # give up (`None`) on the outputs that are not plain copies, the sequential
+    # one must always find them, and `get_entity_spans_from_tokens` must map
+    # them to the character offsets of the sentence. Returns the mismatches
+    codes = {
+        "start_mention_token": _SYNTHETIC_CODES["{"],
+        "end_mention_token": _SYNTHETIC_CODES["}"],
+        "start_entity_token": _SYNTHETIC_CODES["["],
+        "end_entity_token": _SYNTHETIC_CODES["]"],
+        "EOS": 2,
+    }
+    alignments = get_synthetic_alignments(num_outputs, max_length, seed)
+
+    sentences = []
+    offset_mappings = []
+    for _, source, _, _ in alignments:
+        words = ["t{}".format(e) for e in source[1:-1]]
+        sentence = " ".join(words)
+        offsets = [(0, 0)]
+        for word in words:
+            start = offsets[-1][1] + (1 if len(offsets) > 1 else 0)
+            offsets.append((start, start + len(word)))
+        offsets.append((len(sentence), len(sentence)))
+        sentences.append(sentence)
+        offset_mappings.append(offsets)
+
+    vectorized = _align_entity_spans_vectorized(
+        [e[2] for e in alignments], [e[1] for e in alignments], codes
+    )
+    entity_spans = get_entity_spans_from_tokens(
+        sentences,
+        [e[2] for e in alignments],
+        [e[1] for e in alignments],
+        offset_mappings,
+        codes,
+        _synthetic_decode,
+    )
+
+    mismatches = []
+    for (kind, source, output, spans), alignment, entities, offsets in zip(
+        alignments, vectorized, entity_spans, offset_mappings
+    ):
+        if alignment is not None:
+            alignment = [(int(s), int(e), list(t)) for s, e, t in alignment]
+        if alignment != spans and (alignment is not None or kind == "full"):
+            mismatches.append(("vectorized", kind, source, output, spans, alignment))
+
+        alignment = _align_entity_spans_sequential(output, source, codes)
+        if alignment != spans:
+            mismatches.append(("sequential", kind, source, output, spans, alignment))
+
+        expected = [
+            (
+                offsets[start][0],
+                offsets[end - 1][1] - offsets[start][0],
+                _synthetic_decode(title).replace(" ", "_"),
+            )
+            for start, end, title in spans
+        ]
+        if entities != expected:
+            mismatches.append(("offsets", kind, source, output, expected, entities))
+
+    return mismatches
+
+
+_OFFSET_MAPPING_WORDS = [
+    "Visit",
+    "北京",
+    "now",
+    "Zürich",
+    "naïve",
+    "東京都",
+    "😀",
+    "São",
+    "(Paulo)",
+    '"x"',
+    "a-b",
+    "Ωmega",
+]
+
+
+def check_offset_mapping(num_sentences=1000, max_length=8, seed=0):
+    # `get_offset_mapping` on non-ASCII sentences tokenized as byte-level BPE
+    # does: every word (with its leading space) is cut in random pieces of 1 to 3
+    # bytes (plus the space), also inside multi-byte characters, that decode to
+    # U+FFFD alone.
+    # The tokens of every word must cover exactly its characters. Returns the
+    # mismatches as (sentence, word, offsets of its tokens)
+    rng = random.Random(seed)
+    pieces = ["<s>".encode("utf-8"), "</s>".encode("utf-8")]
+    ids = {e: i for i, e in enumerate(pieces)}
+
+    def decode_fn(token_ids):
+        return b"".join(pieces[e] for e in token_ids).decode("utf-8", "replace")
+
+    mismatches = []
+    for _ in range(num_sentences):
+        words = [
+            rng.choice(_OFFSET_MAPPING_WORDS) for _ in range(rng.randint(1, max_length))
+        ]
+        sentence = " ".join(words)
+
+        token_ids = [ids["<s>".encode("utf-8")]]
+        spans = []
+        for i, word in enumerate(words):
+            data = ((" " if i else "") + word).encode("utf-8")
+            first = len(token_ids)
+            position = 0
+            while position < len(data):
+                # as in byte-level BPE, the space is never a piece alone
+                piece = data[
+                    position : position + rng.randint(1, 3) + (data[position] == 32)
+                ]
+                if piece not in ids:
+                    ids[piece] = len(pieces)
+                    pieces.append(piece)
+                token_ids.append(ids[piece])
+                position += len(piece)
+            start = len(" ".join(words[:i])) + (1 if i else 0)
+            spans.append((word, start, start + len(word), first, len(token_ids)))
+        token_ids.append(ids["</s>".encode("utf-8")])
+
+        offsets = get_offset_mapping(sentence, token_ids, decode_fn)
+        for word, start, end, first, last in spans:
+            word_offsets = offsets[first:last]
+            if (
+                word_offsets[0][0] != start
+                or word_offsets[-1][1] != end
+                or any(b <= a or a < start or b > end for a, b in word_offsets)
+            ):
+                mismatches.append((sentence, word, word_offsets))
+
+    return mismatches
+
+
+def read_documents(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_doc_entities(entity_spans):
+    return [
+        (i, start, length, title)
+        for i, spans in enumerate(entity_spans)
+        for start, length, title in spans
+    ]
+
+
+def benchmark_quantization(
+    models, documents, num_beams=5, batch_size=8, **constraints_kwargs
+):
+    # the same constrained decoding with every model (e.g. fp32 and int8):
+    # micro-F1 (strong matching) and generated tokens per second
+    sentences = [e["text"] for e in documents]
+    gold_entities = get_doc_entities([e["entities"] for e in documents])
+
+    results = []
+    for name, model in models.items():
+        entity_spans = []
+        num_tokens = 0
+        elapsed = 0
+        for batch in batch_it(sentences, batch_size):
+            prefix_allowed_tokens_fn = get_end_to_end_prefix_allowed_tokens_fn_hf(
+                model, get_entity_spans_pre_processing(batch), **constraints_kwargs
+            )
+            start = time.perf_counter()
+            outputs = model.sample(
+                get_entity_spans_pre_processing(batch),
+                num_beams=num_beams,
+                num_return_sequences=1,
+                prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+            )
+            elapsed += time.perf_counter() - start
+            num_tokens += sum(len(e[0]["tokens"]) for e in outputs)
+            entity_spans += get_entity_spans_from_tokens(
+                batch,
+                [e[0]["tokens"] for e in outputs],
+                prefix_allowed_tokens_fn.sent_origs,
+                get_input_offset_mappings(
+                    batch, prefix_allowed_tokens_fn, tokenizer=model.tokenizer
+                ),
+                prefix_allowed_tokens_fn.codes,
+                prefix_allowed_tokens_fn.decode_fn,
+            )
+
+        results.append(
+            {
+                "model": name,
+                "micro_f1": get_micro_f1(get_doc_entities(entity_spans), gold_entities),
+                "tokens_per_second": num_tokens / elapsed,
+            }
+        )
+
+    return results
+
+
+def benchmark_adaptive_beam(
+    model,
+    documents,
+    num_beams=5,
+    score_margins=(None, 1.0, 2.0, 5.0),
+    max_len_a=None,
+    max_len_b=16,
+    **constraints_kwargs
+):
+    # micro-F1 (strong matching) and latency of the fixed beam (`None`) and of
+    # the adaptive beam with every margin; `documents` have a "text" and gold
+    # "entities" as (start, length, title)
+    sentences = [e["text"] for e in documents]
+    gold_entities = get_doc_entities([e["entities"] for e in documents])
+
+    results = []
+    for score_margin in score_margins:
+        start = time.perf_counter()
+        entity_spans = _get_entity_spans(
+            model,
+            sentences,
+            get_end_to_end_prefix_allowed_tokens_fn_hf(
+                model, get_entity_spans_pre_processing(sentences), **constraints_kwargs
+            ),
+            num_beams=num_beams,
+            num_return_sequences=1,
+            score_margin=score_margin,
+            max_len_a=max_len_a,
+            max_len_b=max_len_b,
+        )
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "score_margin": score_margin,
+                "micro_f1": get_micro_f1(get_doc_entities(entity_spans), gold_entities),
+                "sentences_per_second": len(sentences) / elapsed,
+                "seconds_per_sentence": elapsed / len(sentences),
+            }
+        )
+
+    return results
+
+
+def _get_random_prefix_allowed_tokens_fn(vocabulary_length, num_beams, seed=0):
+    # random constraints, the same for every call with the same prefix: at
+    # least `num_beams` tokens, so that `generate` never ranks a masked one
+    # among the hypotheses, and EOS one time in three
+    def prefix_allowed_tokens_fn(batch_id, sent):
+        rng = random.Random("{} {} {}".format(seed, batch_id, sent))
+        allowed = rng.sample(range(3, vocabulary_length), rng.randint(num_beams, 8))
+        if rng.random() < 0.3:
+            allowed.append(2)
+        return allowed
+
+    return prefix_allowed_tokens_fn
+
+
+def check_beam_search(
+    num_inputs=20,
+    num_beams=5,
+    max_length=16,
+    length_penalties=(0.5, 1.0, 2.0),
+    early_stoppings=(False, True, "never"),
+    seed=0,
+):
+    # `constrained_beam_search` with `score_margin=inf` against `generate` on a
+    # tiny random BART (nothing to download) under random constraints, with
+    # every length penalty and stopping criterion: returns the settings where
+    # hypotheses or scores differ
+    import torch
+    from transformers import BartConfig, BartForConditionalGeneration
+    from utils import constrained_beam_search
+
+    torch.manual_seed(seed)
+    vocabulary_length = 32
+    model = BartForConditionalGeneration(
+        BartConfig(
+            vocab_size=vocabulary_length,
+            d_model=16,
+            encoder_layers=1,
+            decoder_layers=1,
+            encoder_attention_heads=2,
+            decoder_attention_heads=2,
+            encoder_ffn_dim=32,
+            decoder_ffn_dim=32,
+            max_position_embeddings=64,
+            # the driver only applies the constraints
+            forced_eos_token_id=None,
+        )
+    ).eval()
+    prefix_allowed_tokens_fn = _get_random_prefix_allowed_tokens_fn(
+        vocabulary_length, num_beams, seed
+    )
+
+    rng = random.Random(seed)
+    mismatches = []
+    for batch_id in range(num_inputs):
+        input_ids = torch.tensor(
+            [
+                [0]
+                + [
+                    rng.randrange(3, vocabulary_length)
+                    for _ in range(rng.randint(1, 8))
+                ]
+                + [2]
+            ]
+        )
+        with torch.no_grad():
+            encoder_hidden_states = model.get_encoder()(input_ids=input_ids)[0]
+
+        for length_penalty in length_penalties:
+            for early_stopping in early_stoppings:
+                past_key_values = None
+
+                def decoder_step(tokens, beam_idx):
+                    nonlocal past_key_values
+                    if beam_idx is not None:
+                        past_key_values.reorder_cache(torch.tensor(beam_idx))
+                    outputs = model(
+                        encoder_outputs=(
+                            encoder_hidden_states.expand(len(tokens), -1, -1),
+                        ),
+                        decoder_input_ids=torch.tensor([[e] for e in tokens]),
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                    )
+                    past_key_values = outputs.past_key_values
+                    return outputs.logits[:, -1].log_softmax(-1)
+
+                with torch.no_grad():
+                    outputs = constrained_beam_search(
+                        decoder_step,
+                        batch_id,
+                        prefix_allowed_tokens_fn,
+                        model.config.decoder_start_token_id,
+                        model.config.eos_token_id,
+                        num_beams=num_beams,
+                        num_return_sequences=num_beams,
+                        max_length=max_length,
+                        length_penalty=length_penalty,
+                        early_stopping=early_stopping,
+                    )
+                    generated = model.generate(
+                        input_ids,
+                        num_beams=num_beams,
+                        num_return_sequences=num_beams,
+                        max_length=max_length,
+                        length_penalty=length_penalty,
+                        early_stopping=early_stopping,
+                        prefix_allowed_tokens_fn=lambda _, sent: (
+                            prefix_allowed_tokens_fn(batch_id, sent.tolist())
+                        ),
+                        return_dict_in_generate=True,
+                        output_scores=True,
+                    )
+
+                references = [
+                    (score, [e for e in sent if e != model.config.pad_token_id])
+                    for sent, score in zip(
+                        generated.sequences.tolist(),
+                        generated.sequences_scores.tolist(),
+                    )
+                ]
+                if [e[1] for e in outputs] != [e[1] for e in references] or any(
+                    abs(a[0] - b[0]) > 1e-4 for a, b in zip(outputs, references)
+                ):
+                    mismatches.append(
+                        (batch_id, length_penalty, early_stopping, outputs, references)
+                    )
+
+    return mismatches
+
+
+def benchmark_export(model, exported, sentences, num_beams=5, **constraints_kwargs):
+    # the reference `generate` of the eager model, the beam search driven by
+    # the eager model and by the exported encoder / decoder step, after one
+    # warm-up sentence each: sentences per second and the fraction of sentences
+    # with the same top output as `generate`
+    generation_kwargs = {}
+    for key in ("length_penalty", "early_stopping"):
+        value = getattr(model.generation_config, key, None)
+        if value is not None:
+            generation_kwargs[key] = value
+
+    results = {}
+    for name, m, sample_kwargs in (
+        # `generate`, whose batched processor masks the beams with nothing
+        # allowed instead of raising
+        ("generate", model, {"batched_constraints": True}),
+        ("eager", model, {"score_margin": float("inf")}),
+        (
+            "exported",
+            exported,
+            dict(generation_kwargs, score_margin=float("inf")),
+        ),
+    ):
+
+        def sample(batch):
+            return m.sample(
+                get_entity_spans_pre_processing(batch),
+                num_beams=num_beams,
+                num_return_sequences=1,
+                prefix_allowed_tokens_fn=get_end_to_end_prefix_allowed_tokens_fn_hf(
+                    model, get_entity_spans_pre_processing(batch), **constraints_kwargs
+                ),
+                **sample_kwargs,
+            )
+
+        sample(sentences[:1])
+        start = time.perf_counter()
+        outputs = sample(sentences)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            # without the padding of the batched `generate`
+            "tokens": [
+                [t for t in e[0]["tokens"] if t != model.config.pad_token_id]
+                for e in outputs
+            ],
+            "sentences_per_second": len(sentences) / elapsed,
+        }
+
+    for name in ("eager", "exported"):
+        results[name]["agreement"] = sum(
+            a == b
+            for a, b in zip(results["generate"]["tokens"], results[name]["tokens"])
+        ) / len(sentences)
+    return results
+
+
+def _get_private_memory():
+    # anonymous memory cannot be shared, while clean pages of a mapped file or
+    # shared memory segment are counted once per host however many map them
+    with open("/proc/self/smaps_rollup") as f:
+        return sum(
+            int(line.split()[1]) * 1024 for line in f if line.startswith("Anonymous:")
+        )
+
+
+def _attach_trie_worker(pickled_trie):
+    before = _get_private_memory()
+    trie = pickle.loads(pickled_trie)
+    # touch every page of the trie
+    int(trie.offsets.sum()) + int(trie.tokens.sum()) + int(trie.targets.sum())
+    trie.get([])
+    return _get_private_memory() - before
+
+
+def benchmark_shared_workers(
+    num_sequences=1000000, num_workers=4, shared_memory=False, seed=0
+):
+    trie = ArrayTrie(get_synthetic_sequences(num_sequences, seed=seed))
+    trie_size = trie.offsets.nbytes + trie.tokens.nbytes + trie.targets.nbytes
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if shared_memory:
+            segment = trie.save_to_shared_memory()
+            trie = ArrayTrie.load_from_shared_memory(segment.name)
+        else:
+            trie.save_to_file(os.path.join(tmp_dir, "trie.bin"))
+            trie = ArrayTrie.load_from_file(os.path.join(tmp_dir, "trie.bin"))
+
+        pickled_trie = pickle.dumps(trie)
+        with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+            private_memory = pool.map(_attach_trie_worker, [pickled_trie] * num_workers)
+
+        if shared_memory:
+            del trie
+            segment.close()
+            segment.unlink()
+
+    # every worker only maps the shared pages, none of them copies the trie
+    assert max(private_memory) < trie_size / 10, (private_memory, trie_size)
+
+    return {
+        "trie_size": trie_size,
+        "pickled_size": len(pickled_trie),
+        "private_memory": private_memory,
+    }
+
+
+# synthetic vocabulary for the constraints benchmark: token `i` is the word
+# "t<i>", the special tokens are 4 to 7 and titles / sentences start after them
+_SYNTHETIC_CODES = {"{": 4, "}": 5, "[": 6, "]": 7}
+_SYNTHETIC_FIRST_TOKEN = 8
+
+
+def _synthetic_encode(sentence):
+    return (
+        [0]
+        + [
+            _SYNTHETIC_CODES[e] if e in _SYNTHETIC_CODES else int(e[1:])
+            for e in sentence.split()
+        ]
+        + [2]
+    )
+
+
+def _synthetic_decode(tokens):
+    codes = {v: k for k, v in _SYNTHETIC_CODES.items()}
+    return " ".join(codes.get(e, "t{}".format(e)) for e in tokens)
+
+
+def get_synthetic_titles(num_titles, vocabulary_length=50265, max_length=8, seed=0):
+    rng = random.Random(seed)
+    return [
+        [
+            rng.randrange(_SYNTHETIC_FIRST_TOKEN, vocabulary_length)
+            for _ in range(rng.randint(1, max_length))
+        ]
+        for _ in range(num_titles)
+    ]
+
+
+def get_synthetic_sentences(
+    titles, num_sentences, sentence_length, mention_rate=0.2, seed=0
+):
+    # random tokens with titles (that also are the mentions) mixed in
+    rng = random.Random(seed)
+    vocabulary_length = max(max(e) for e in titles[:1000]) + 1
+    sentences = []
+    for _ in range(num_sentences):
+        tokens = []
+        while len(tokens) < sentence_length:
+            if rng.random() < mention_rate:
+                tokens += rng.choice(titles)
+            else:
+                tokens.append(rng.randrange(_SYNTHETIC_FIRST_TOKEN, vocabulary_length))
+        sentences.append(_synthetic_decode(tokens[:sentence_length]))
+    return sentences
+
+
+def _build_constraint_tries(trie_type, titles):
+    # mention trie (mention + EOS) and candidates trie ("} [ title ] EOS") as
+    # `_get_end_to_end_prefix_allowed_tokens_fn` expects them
+    if trie_type == "dummy":
+        return None, None
+
+    trie_cls = {"trie": Trie, "marisa": MarisaTrie, "array": ArrayTrie}[trie_type]
+    return (
+        trie_cls([e + [2] for e in titles]),
+        trie_cls(
+            [
+                [_SYNTHETIC_CODES["}"], _SYNTHETIC_CODES["["]]
+                + e
+                + [_SYNTHETIC_CODES["]"], 2]
+                for e in titles
+            ]
+        ),
+    )
+
+
+def drive_prefix_allowed_tokens_fn(
+    prefix_allowed_tokens_fn,
+    num_sentences,
+    num_beams=5,
+    max_length=256,
+    special_rate=0.3,
+    seed=0,
+):
+    # replays the calls of a beam search without a model: at every step the
+    # function is called for every live beam of every sentence, and each beam
+    # is extended with up to two random allowed tokens (special tokens are
+    # preferred with probability `special_rate` so that mentions and entities
+    # get opened and closed); returns the latency of every call and a checksum
+    # of the explored prefixes
+    rng = random.Random(seed)
+    special_tokens = set(_SYNTHETIC_CODES.values()) | {2}
+    beams = [(batch_id, [2]) for batch_id in range(num_sentences)]
+    latencies = []
+    checksum = 0
+    while beams:
+        children = {}
+        for batch_id, sent in beams:
+            start = time.perf_counter()
+            allowed = prefix_allowed_tokens_fn(batch_id, sent)
+            latencies.append(time.perf_counter() - start)
+
+            # sorted, as every trie returns the children in its own order
+            allowed = [allowed] if isinstance(allowed, int) else sorted(allowed)
+            checksum = hash((checksum, len(allowed)))
+            if not allowed:
+                continue
+
+            specials = [e for e in allowed if e in special_tokens]
+            for _ in range(min(2, len(allowed))):
+                if specials and rng.random() < special_rate:
+                    token = rng.choice(specials)
+                else:
+                    token = rng.choice(allowed)
+                children.setdefault(batch_id, {})[tuple(sent + [token])] = None
+
+        beams = []
+        for batch_id, sents in sorted(children.items()):
+            sents = list(sents)
+            rng.shuffle(sents)
+            beams += [
+                (batch_id, list(e))
+                for e in sents[:num_beams]
+                if e[-1] != 2 and len(e) < max_length
+            ]
+
+    return latencies, checksum
+
+
+def _get_percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _benchmark_constraints_worker(
+    trie_type,
+    num_titles,
+    beam_sizes,
+    sentence_lengths,
+    num_sentences,
+    vocabulary_length,
+    repeat,
+    seed,
+):
+    titles = get_synthetic_titles(num_titles, vocabulary_length, seed=seed)
+
+    memory = _get_private_memory()
+    start = time.perf_counter()
+    mention_trie, candidates_trie = _build_constraint_tries(trie_type, titles)
+    build_time = time.perf_counter() - start
+    memory = _get_private_memory() - memory
+
+    results = []
+    for sentence_length in sentence_lengths:
+        sentences = get_synthetic_sentences(
+            titles, num_sentences, sentence_length, seed=seed
+        )
+        for num_beams in beam_sizes:
+            # best of `repeat` runs for every percentile, as in `time_calls`
+            percentiles = {}
+            for _ in range(repeat):
+                latencies, checksum = drive_prefix_allowed_tokens_fn(
+                    _get_end_to_end_prefix_allowed_tokens_fn(
+                        _synthetic_encode,
+                        _synthetic_decode,
+                        0,
+                        1,
+                        2,
+                        vocabulary_length,
+                        sentences,
+                        mention_trie=mention_trie,
+                        candidates_trie=candidates_trie,
+                        incremental=True,
+                    ),
+                    num_sentences,
+                    num_beams,
+                    max_length=4 * sentence_length,
+                    seed=seed,
+                )
+                latencies.sort()
+                for q in (0.5, 0.9, 0.99):
+                    percentiles[q] = min(
+                        percentiles.get(q, float("inf")),
+                        _get_percentile(latencies, q),
+                    )
+            results.append(
+                {
+                    "trie_type": trie_type,
+                    "num_titles": num_titles,
+                    "sentence_length": sentence_length,
+                    "num_beams": num_beams,
+                    "build_time": build_time,
+                    "memory": memory,
+                    "num_calls": len(latencies),
+                    "p50": percentiles[0.5],
+                    "p90": percentiles[0.9],
+                    "p99": percentiles[0.99],
+                    "checksum": checksum,
+                }
+            )
+
+    return results
+
+
+def benchmark_constraints(
+    trie_types=("trie", "marisa", "array", "dummy"),
+    sizes=(10000, 100000, 1000000),
+    beam_sizes=(1, 5, 10),
+    sentence_lengths=(32, 128),
+    num_sentences=16,
+    vocabulary_length=50265,
+    repeat=3,
+    seed=0,
+):
+    # every (trie type, size) runs in a fresh process, so that build time and
+    # memory are not affected by the previous ones; the dummy tries do not
+    # depend on the size and run once
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for trie_type in trie_types:
+        for num_titles in sizes[:1] if trie_type == "dummy" else sizes:
+            with context.Pool(1) as pool:
+                results += pool.apply(
+                    _benchmark_constraints_worker,
+                    (
+                        trie_type,
+                        num_titles,
+                        beam_sizes,
+                        sentence_lengths,
+                        num_sentences,
+                        vocabulary_length,
+                        repeat,
+                        seed,
+                    ),
+                )
+
+    # the exact tries must allow the same tokens, hence explore the same prefixes
+    checksums = {}
+    for result in results:
+        if result["trie_type"] != "dummy":
+            key = (result["num_titles"], result["sentence_length"], result["num_beams"])
+            checksums.setdefault(key, set()).add(result["checksum"])
+    assert all(len(e) == 1 for e in checksums.values()), checksums
+
+    return results
+
+
+def check_constraints_regressions(results, baseline, tolerance=0.5):
+    # compares latency percentiles, build time and memory with a previous run
+    # on the same machine; returns the regressions as readable strings
+    def get_key(result):
+        return (
+            result["trie_type"],
+            result["num_titles"],
+            result["sentence_length"],
+            result["num_beams"],
+        )
+
+    baseline = {get_key(e): e for e in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get(get_key(result))
+        if reference is None:
+            continue
+        if result["checksum"] != reference["checksum"]:
+            regressions.append("{} allowed tokens changed".format(get_key(result)))
+        for metric in ("p50", "p90", "p99", "build_time", "memory"):
+            # below a millisecond / a megabyte changes are noise
+            floor = (
+                2**20 if metric == "memory" else 1e-3 if metric == "build_time" else 0
+            )
+            if result[metric] > max(reference[metric], floor) * (1 + tolerance):
+                regressions.append(
+                    "{} {} {:.4g} -> {:.4g}".format(
+                        get_key(result), metric, reference[metric], result[metric]
+                    )
+                )
+    return regressions
+
+
+# lines on which a regex parser easily differs from html.parser: text with
+# `<` / `>`, attributes before `href`, quotes, case, tags without an href
+PARAGRAPH_ANCHORS_LINES = [
+    'Paris is the <a href="capital%20city">capital</a> of <a href="France">France</a>.',
+    'A &amp; B &lt;x&gt; <a href="Tom%20%26amp%3B%20Jerry">Tom &amp; Jerry</a>',
+    '<a href="">empty href</a> and <a href="X"><i>nested</i> tag</a> é ü 東京',
+    'if a < b <a href="Foo">foo</a> then c > d',
+    'x <- <a href="Bar">bar</a> and 1<2, 3 <= 4 <3',
+    '<a title="t &gt; u" href="F">f</a>, <a href=\'C\'>c</a>, <A HREF=D>d</A>',
+    '<a name="x">no href</a> <abbr title="y">abbr</abbr> <a href="G"><b>g</b></a>',
+    "no anchors at all",
+]
+
+
+def _get_paragraph_anchors_bs4(line):
+    # the previous BeautifulSoup parse of `extract_pages`
+    import bs4
+
+    paragraph = ""
+    anchors = []
+    for span in bs4.BeautifulSoup(line, "html.parser"):
+        if isinstance(span, bs4.element.Tag):
+            if span.get("href", None):
+                anchors.append(
+                    (
+                        span["href"],
+                        len(paragraph),
+                        len(paragraph) + len(span.get_text()),
+                    )
+                )
+            paragraph += span.get_text()
+        else:
+            paragraph += str(span)
+    return paragraph, anchors
+
+
+def check_paragraph_anchors(lines=PARAGRAPH_ANCHORS_LINES):
+    # `get_paragraph_anchors` against BeautifulSoup (needs bs4): returns the
+    # lines where text or anchors differ
+    mismatches = []
+    for line in lines:
+        output = get_paragraph_anchors(line)
+        reference = _get_paragraph_anchors_bs4(line)
+        if output != reference:
+            mismatches.append((line, output, reference))
+    return mismatches
+
+
+def main_marisa(args):
+    for num_sequences in args.num_sequences:
+        result = benchmark_marisa_trie_get(num_sequences, args.num_prefixes, args.seed)
+        print(
+            "MarisaTrie.get n={:d} build={:.1f}s keys_scan={:.1f}us child_index={:.1f}us".format(
+                result["num_sequences"],
+                result["build_time"],
+                result["keys_scan"] * 1e6,
+                result["child_index"] * 1e6,
+            )
+        )
+
+
+def main_constraints(args):
+    results = benchmark_constraints(
+        args.trie_types,
+        args.sizes,
+        args.beam_sizes,
+        args.sentence_lengths,
+        args.num_sentences,
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+    for result in results:
+        print(
+            "{} n={:d} length={:d} num_beams={:d} build={:.2f}s memory={:.1f}MB "
+            "calls={:d} p50={:.1f}us p90={:.1f}us p99={:.1f}us".format(
+                result["trie_type"],
+                result["num_titles"],
+                result["sentence_length"],
+                result["num_beams"],
+                result["build_time"],
+                result["memory"] / 2**20,
+                result["num_calls"],
+                result["p50"] * 1e6,
+                result["p90"] * 1e6,
+                result["p99"] * 1e6,
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = check_constraints_regressions(
+                results, json.load(f), args.tolerance
+            )
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+def main_logits_processor(args):
+    from m2e_module import M2E
+
+    model = M2E.from_pretrained(args.model).eval()
+    with open(args.sentences) as f:
+        sentences = [line.strip() for line in f if line.strip()]
+    mention_trie = None
+    if args.mention_trie:
+        with open(args.mention_trie, "rb") as f:
+            mention_trie = pickle.load(f)
+
+    for result in benchmark_logits_processor(
+        model, sentences, args.beam_sizes, mention_trie=mention_trie, incremental=True
+    ):
+        print(
+            "generate num_beams={:d} batched_constraints={} {:.2f} sentences/s".format(
+                result["num_beams"],
+                result["batched_constraints"],
+                result["sentences_per_second"],
+            )
+        )
+
+
+def main_alignment(args):
+    from m2e_module import M2E
+
+    model = M2E.from_pretrained(args.model).eval()
+    with open(args.sentences) as f:
+        sentences = [line.strip() for line in f if line.strip()]
+    mention_trie = None
+    if args.mention_trie:
+        with open(args.mention_trie, "rb") as f:
+            mention_trie = pickle.load(f)
+
+    result = benchmark_alignment(
+        model, sentences, args.num_beams, mention_trie=mention_trie, incremental=True
+    )
+    for sent, strings, tokens in result["mismatches"]:
+        print("MISMATCH {}\n  strings: {}\n  tokens:  {}".format(sent, strings, tokens))
+    print(
+        "alignment n={:d} mismatches={:d} strings_failed={:d} "
+        "strings={:.2f}ms tokens={:.2f}ms".format(
+            result["num_sentences"],
+            len(result["mismatches"]),
+            result["strings_failed"],
+            result["strings_time"] * 1e3,
+            result["tokens_time"] * 1e3,
+        )
+    )
+
+
+def main_check_alignment(args):
+    mismatches = check_alignment(args.num_outputs, args.max_length, args.seed)
+    for aligner, kind, source, output, expected, found in mismatches:
+        print(
+            "MISMATCH {} ({} output)\n  source: {}\n  output: {}\n"
+            "  expected: {}\n  found:    {}".format(
+                aligner, kind, source, output, expected, found
+            )
+        )
+    offset_mismatches = check_offset_mapping(
+        args.num_outputs, args.max_length, args.seed
+    )
+    for sentence, word, offsets in offset_mismatches:
+        print(
+            "MISMATCH get_offset_mapping {!r}\n  word: {!r}\n  offsets: {}".format(
+                sentence, word, offsets
+            )
+        )
+    print(
+        "check_alignment n={:d} mismatches={:d} offset_mapping_mismatches={:d}".format(
+            args.num_outputs, len(mismatches), len(offset_mismatches)
+        )
+    )
+    if mismatches or offset_mismatches:
+        sys.exit(1)
+
+
+def main_adaptive_beam(args):
+    from m2e_module import M2E
+
+    model = M2E.from_pretrained(args.model).eval()
+    documents = read_documents(args.documents)
+    constraints_kwargs = {"incremental": True}
+    if args.mention_trie:
+        with open(args.mention_trie, "rb") as f:
+            constraints_kwargs["mention_trie"] = pickle.load(f)
+    if args.mention_to_candidates:
+        with open(args.mention_to_candidates, "rb") as f:
+            constraints_kwargs["mention_to_candidates_dict"] = pickle.load(f)
+
+    for result in benchmark_adaptive_beam(
+        model,
+        documents,
+        args.num_beams,
+        [None] + args.score_margins,
+        args.max_len_a,
+        args.max_len_b,
+        **constraints_kwargs,
+    ):
+        print(
+            "num_beams={:d} score_margin={} micro_f1={:.4f} "
+            "{:.2f} sentences/s ({:.0f}ms/sentence)".format(
+                args.num_beams,
+                result["score_margin"],
+                result["micro_f1"],
+                result["sentences_per_second"],
+                result["seconds_per_sentence"] * 1e3,
+            )
+        )
+
+
+def main_quantization(args):
+    from m2e_module import M2E, mM2E
+
+    model_cls = mM2E if args.multilingual else M2E
+    models = {
+        "fp32": model_cls.from_pretrained(args.model).eval(),
+        "int8": model_cls.from_pretrained(args.model, quantize=True).eval(),
+    }
+    documents = read_documents(args.documents)
+    constraints_kwargs = {"incremental": True}
+    if args.mention_trie:
+        with open(args.mention_trie, "rb") as f:
+            constraints_kwargs["mention_trie"] = pickle.load(f)
+    if args.mention_to_candidates:
+        with open(args.mention_to_candidates, "rb") as f:
+            constraints_kwargs["mention_to_candidates_dict"] = pickle.load(f)
+
+    results = benchmark_quantization(
+        models, documents, args.num_beams, args.batch_size, **constraints_kwargs
+    )
+    for result in results:
+        print(
+            "{} micro_f1={:.4f} {:.1f} tokens/s".format(
+                result["model"], result["micro_f1"], result["tokens_per_second"]
+            )
+        )
+    print(
+        "int8 vs fp32: micro_f1 {:+.4f}, speedup {:.2f}x".format(
+            results[1]["micro_f1"] - results[0]["micro_f1"],
+            results[1]["tokens_per_second"] / results[0]["tokens_per_second"],
+        )
+    )
+
+
+def main_export(args):
+    from export import ExportedM2E
+    from m2e_module import M2E, mM2E
+
+    model = (mM2E if args.multilingual else M2E).from_pretrained(args.model).eval()
+    exported = ExportedM2E.from_pretrained(args.exported)
+    sentences = [e["text"] for e in read_documents(args.documents)]
+    constraints_kwargs = {"incremental": True}
+    if args.mention_trie:
+        with open(args.mention_trie, "rb") as f:
+            constraints_kwargs["mention_trie"] = pickle.load(f)
+    if args.mention_to_candidates:
+        with open(args.mention_to_candidates, "rb") as f:
+            constraints_kwargs["mention_to_candidates_dict"] = pickle.load(f)
+
+    results = benchmark_export(
+        model, exported, sentences, args.num_beams, **constraints_kwargs
+    )
+    print(
+        "generate {:.2f} sentences/s".format(
+            results["generate"]["sentences_per_second"]
+        )
+    )
+    for name in ("eager", "exported"):
+        print(
+            "{} {:.2f} sentences/s ({:.2f}x), agreement with generate {:.4f}".format(
+                name,
+                results[name]["sentences_per_second"],
+                results[name]["sentences_per_second"]
+                / results["generate"]["sentences_per_second"],
+                results[name]["agreement"],
+            )
+        )
+
+
+def main_beam_search(args):
+    mismatches = check_beam_search(
+        args.num_inputs, args.num_beams, args.max_length, seed=args.seed
+    )
+    for batch_id, length_penalty, early_stopping, outputs, references in mismatches:
+        print(
+            "MISMATCH input={:d} length_penalty={} early_stopping={}\n"
+            "  constrained_beam_search: {}\n  generate: {}".format(
+                batch_id, length_penalty, early_stopping, outputs, references
+            )
+        )
+    print("beam_search n={:d} mismatches={:d}".format(args.num_inputs, len(mismatches)))
+    if mismatches:
+        sys.exit(1)
+
+
+def main_check_paragraph_anchors(args):
+    lines = list(PARAGRAPH_ANCHORS_LINES)
+    for path in args.input:
+        with open(path) as f:
+            lines += [
+                line
+                for line in f
+                if not line.startswith("<doc id=") and not line.startswith("</doc>")
+            ]
+
+    mismatches = check_paragraph_anchors(lines)
+    for line, output, reference in mismatches:
+        print("MISMATCH {!r}\n  regex: {}\n  bs4:   {}".format(line, output, reference))
+    print(
+        "check_paragraph_anchors n={:d} mismatches={:d}".format(
+            len(lines), len(mismatches)
+        )
+    )
+    if mismatches:
+        sys.exit(1)
+
+
+def main_shared_workers(args):
+    result = benchmark_shared_workers(
+        args.num_sequences, args.num_workers, args.shared_memory, args.seed
+    )
+    print(
+        "ArrayTrie trie={:.1f}MB pickled={:d}B private per worker={}".format(
+            result["trie_size"] / 2**20,
+            result["pickled_size"],
+            ", ".join("{:.1f}MB".format(e / 2**20) for e in result["private_memory"]),
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    marisa_parser = subparsers.add_parser(
+        "marisa", help="MarisaTrie.get keys scan vs child index"
+    )
+    marisa_parser.add_argument(
+        "--num_sequences",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="synthetic trie sizes [%(default)s]",
+    )
+    marisa_parser.add_argument(
+        "--num_prefixes",
+        type=int,
+        default=1000,
+        help="number of looked up prefixes [%(default)d]",
+    )
+    marisa_parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [%(default)d]"
+    )
+    marisa_parser.set_defaults(func=main_marisa)
+
+    constraints_parser = subparsers.add_parser(
+        "constraints",
+        help="prefix_allowed_tokens_fn latency, trie memory and build time "
+        "on synthetic tries, without a model",
+    )
+    constraints_parser.add_argument(
+        "--trie_types",
+        type=str,
+        nargs="+",
+        choices=["trie", "marisa", "array", "dummy"],
+        default=["trie", "marisa", "array", "dummy"],
+        help="tries used for mentions and candidates [%(default)s]",
+    )
+    constraints_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="number of synthetic titles, up to 10000000 [%(default)s]",
+    )
+    constraints_parser.add_argument(
+        "--beam_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 5, 10],
+        help="beam sizes [%(default)s]",
+    )
+    constraints_parser.add_argument(
+        "--sentence_lengths",
+        type=int,
+        nargs="+",
+        default=[32, 128],
+        help="source sentence lengths in tokens [%(default)s]",
+    )
+    constraints_parser.add_argument(
+        "--num_sentences",
+        type=int,
+        default=16,
+        help="sentences in the batch [%(default)d]",
+    )
+    constraints_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per configuration, the fastest counts [%(default)d]",
+    )
+    constraints_parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [%(default)d]"
+    )
+    constraints_parser.add_argument(
+        "--save", type=str, default=None, help="write the results to this json"
+    )
+    constraints_parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="json of a previous --save: exit with 1 on regressions",
+    )
+    constraints_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="relative slowdown / growth counted as a regression [%(default)s]",
+    )
+    constraints_parser.set_defaults(func=main_constraints)
+
+    processor_parser = subparsers.add_parser(
+        "logits_processor",
+        help="prefix_allowed_tokens_fn vs batched logits processor in generate",
+    )
+    processor_parser.add_argument("--model", type=str, help="M2E model path")
+    processor_parser.add_argument(
+        "--sentences", type=str, help="text file with one input sentence per line"
+    )
+    processor_parser.add_argument(
+        "--mention_trie", type=str, default=None, help="pickled mention trie"
+    )
+    processor_parser.add_argument(
+        "--beam_sizes",
+        type=int,
+        nargs="+",
+        default=[5, 10, 20],
+        help="beam sizes [%(default)s]",
+    )
+    processor_parser.set_defaults(func=main_logits_processor)
+
+    alignment_parser = subparsers.add_parser(
+        "alignment",
+        help="token aligner vs post-processing and get_entity_spans_finalize",
+    )
+    alignment_parser.add_argument("--model", type=str, help="M2E model path")
+    alignment_parser.add_argument(
+        "--sentences", type=str, help="text file with one input sentence per line"
+    )
+    alignment_parser.add_argument(
+        "--mention_trie", type=str, default=None, help="pickled mention trie"
+    )
+    alignment_parser.add_argument(
+        "--num_beams", type=int, default=5, help="beam size [%(default)d]"
+    )
+    alignment_parser.set_defaults(func=main_alignment)
+
+    check_alignment_parser = subparsers.add_parser(
+        "check_alignment",
+        help="token aligners and offsets on synthetic outputs, no model needed",
+    )
+    check_alignment_parser.add_argument(
+        "--num_outputs",
+        type=int,
+        default=10000,
+        help="synthetic outputs [%(default)d]",
+    )
+    check_alignment_parser.add_argument(
+        "--max_length",
+        type=int,
+        default=12,
+        help="max source tokens [%(default)d]",
+    )
+    check_alignment_parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [%(default)d]"
+    )
+    check_alignment_parser.set_defaults(func=main_check_alignment)
+
+    adaptive_parser = subparsers.add_parser(
+        "adaptive_beam",
+        help="micro-F1 and latency of fixed vs adaptive beam (e.g. AIDA test)",
+    )
+    adaptive_parser.add_argument("--model", type=str, help="M2E model path")
+    adaptive_parser.add_argument(
+        "--documents",
+        type=str,
+        help='jsonl with "text" and gold "entities" as [start, length, title]',
+    )
+    adaptive_parser.add_argument(
+        "--mention_trie", type=str, default=None, help="pickled mention trie"
+    )
+    adaptive_parser.add_argument(
+        "--mention_to_candidates",
+        type=str,
+        default=None,
+        help="pickled dict from mention to list of candidate titles",
+    )
+    adaptive_parser.add_argument(
+        "--num_beams", type=int, default=5, help="beam size [%(default)d]"
+    )
+    adaptive_parser.add_argument(
+        "--score_margins",
+        type=float,
+        nargs="+",
+        default=[1.0, 2.0, 5.0],
+        help="log-prob margins of the adaptive beam [%(default)s]",
+    )
+    adaptive_parser.add_argument(
+        "--max_len_a",
+        type=float,
+        default=None,
+        help="cap max_length to max_len_a * source length + max_len_b",
+    )
+    adaptive_parser.add_argument(
+        "--max_len_b", type=int, default=16, help="see --max_len_a [%(default)d]"
+    )
+    adaptive_parser.set_defaults(func=main_adaptive_beam)
+
+    quantization_parser = subparsers.add_parser(
+        "quantization",
+        help="micro-F1 and tokens/s of the int8 model vs fp32 on held-out documents",
+    )
+    quantization_parser.add_argument("--model", type=str, help="M2E model path")
+    quantization_parser.add_argument(
+        "--multilingual", action="store_true", help="load with mM2E?"
+    )
+    quantization_parser.add_argument(
+        "--documents",
+        type=str,
+        help='jsonl with "text" and gold "entities" as [start, length, title]',
+    )
+    quantization_parser.add_argument(
+        "--mention_trie", type=str, default=None, help="pickled mention trie"
+    )
+    quantization_parser.add_argument(
+        "--mention_to_candidates",
+        type=str,
+        default=None,
+        help="pickled dict from mention to list of candidate titles",
+    )
+    quantization_parser.add_argument(
+        "--num_beams", type=int, default=5, help="beam size [%(default)d]"
+    )
+    quantization_parser.add_argument(
+        "--batch_size", type=int, default=8, help="sentences per batch [%(default)d]"
+    )
+    quantization_parser.set_defaults(func=main_quantization)
+
+    beam_parser = subparsers.add_parser(
+        "beam_search",
+        help="constrained_beam_search vs generate on a tiny random model",
+    )
+    beam_parser.add_argument(
+        "--num_inputs", type=int, default=20, help="random inputs [%(default)d]"
+    )
+    beam_parser.add_argument(
+        "--num_beams", type=int, default=5, help="beam size [%(default)d]"
+    )
+    beam_parser.add_argument(
+        "--max_length", type=int, default=16, help="max_length [%(default)d]"
+    )
+    beam_parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [%(default)d]"
+    )
+    beam_parser.set_defaults(func=main_beam_search)
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="sentences/s and agreement of the TorchScript export vs generate",
+    )
+    export_parser.add_argument("--model", type=str, help="M2E model path")
+    export_parser.add_argument(
+        "--exported", type=str, help="directory written by export.py"
+    )
+    export_parser.add_argument(
+        "--multilingual", action="store_true", help="load with mM2E?"
+    )
+    export_parser.add_argument(
+        "--documents", type=str, help='jsonl with a "text" per document'
+    )
+    export_parser.add_argument(
+        "--mention_trie", type=str, default=None, help="pickled mention trie"
+    )
+    export_parser.add_argument(
+        "--mention_to_candidates",
+        type=str,
+        default=None,
+        help="pickled dict from mention to list of candidate titles",
+    )
+    export_parser.add_argument(
+        "--num_beams", type=int, default=5, help="beam size [%(default)d]"
+    )
+    export_parser.set_defaults(func=main_export)
+
+    workers_parser = subparsers.add_parser(
+        "shared_workers",
+        help="private memory of worker processes attached to one ArrayTrie",
+    )
+    workers_parser.add_argument(
+        "--num_sequences",
+        type=int,
+        default=1000000,
+        help="synthetic trie size [%(default)d]",
+    )
+    workers_parser.add_argument(
+        "--num_workers", type=int, default=4, help="worker processes [%(default)d]"
+    )
+    workers_parser.add_argument(
+        "--shared_memory",
+        action="store_true",
+        help="share through a shared memory segment instead of a mapped file?",
+    )
+    workers_parser.add_argument(
+        "--seed", type=int, default=0, help="random seed [%(default)d]"
+    )
+    workers_parser.set_defaults(func=main_shared_workers)
+
+    anchors_parser = subparsers.add_parser(
+        "check_paragraph_anchors",
+        help="regex anchor parser of extract_pages vs BeautifulSoup (needs bs4)",
+    )
+    anchors_parser.add_argument(
+        "--input",
+        type=str,
+        nargs="*",
+        default=[],
+        help="WikiExtractor files whose lines are also compared",
+    )
+    anchors_parser.set_defaults(func=main_check_paragraph_anchors)
+
+    args = parser.parse_args()
+    args.func(args)
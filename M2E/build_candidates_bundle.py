@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import pickle
+import time
+from multiprocessing import Pool
+
+from transformers import BartTokenizer, XLMRobertaTokenizer
+from build_trie import build_trie_file
+from trie import CandidatesTrieBundle
+from utils import batch_it
+
+logger = logging.getLogger(__name__)
+
+_encode_fn = None
+
+
+def get_bundle_sequences(
+    items,
+    encode_fn,
+    end_mention_token="}",
+    start_entity_token="[",
+    end_entity_token="]",
+):
+    # the mention is encoded as it appears inside a sentence (after a space) and
+    # at its beginning or after a bracket, quote or hyphen, as in
+    # `get_mention_ids_to_candidates_dict`: mentions with the same ids share a
+    # subtrie, so their candidates are merged
+    sequences = []
+    for mention, candidates in items:
+        candidates_sequences = [
+            encode_fn(
+                " {} {} {} {}".format(
+                    end_mention_token, start_entity_token, e, end_entity_token
+                )
+            )[1:]
+            for e in candidates
+        ]
+        if mention is None:
+            # the default entry used for mentions without candidates
+            mention_sequences = [()]
+        else:
+            mention_sequences = {
+                tuple(encode_fn(variant)[1:-1])
+                for variant in (" {}".format(mention.strip()), mention.strip())
+            }
+        for mention_sequence in mention_sequences:
+            sequences += CandidatesTrieBundle.get_sequences(
+                mention_sequence, candidates_sequences
+            )
+    return sequences
+
+
+def _init_worker(tokenizer_name_or_path, multilingual):
+    global _encode_fn
+    tokenizer = (
+        XLMRobertaTokenizer if multilingual else BartTokenizer
+    ).from_pretrained(tokenizer_name_or_path)
+    _encode_fn = tokenizer.encode
+
+
+def _get_bundle_sequences(items):
+    return get_bundle_sequences(items, _encode_fn)
+
+
+def build_candidates_bundle(
+    mention_to_candidates_dict,
+    tokenizer_name_or_path,
+    output_path,
+    multilingual=False,
+    processes=1,
+    chunk_size=10000,
+    tmp_dir=None,
+):
+    start = time.time()
+    items = [(None, ["NIL"])] + list(mention_to_candidates_dict.items())
+
+    def _iter_sequences(pool):
+        for i, chunk_sequences in enumerate(
+            pool.imap(_get_bundle_sequences, batch_it(items, chunk_size))
+        ):
+            yield from chunk_sequences
+            logger.info(
+                "encoded {}/{} mentions ({:.0f}s)".format(
+                    min((i + 1) * chunk_size, len(items)),
+                    len(items),
+                    time.time() - start,
+                )
+            )
+
+    with Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(tokenizer_name_or_path, multilingual),
+    ) as pool:
+        build_trie_file(_iter_sequences(pool), output_path, tmp_dir=tmp_dir)
+
+    bundle = CandidatesTrieBundle.load_from_file(output_path)
+    logger.info(
+        "saved {} sequences in {} ({:.0f}s)".format(
+            len(bundle), output_path, time.time() - start
+        )
+    )
+    return bundle
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mention_to_candidates",
+        type=str,
+        help="pickled dict from mention to list of candidate titles",
+    )
+    parser.add_argument("--tokenizer", type=str, help="M2E model / tokenizer path")
+    parser.add_argument("--output", type=str, help="output bundle file")
+    parser.add_argument(
+        "--multilingual", action="store_true", help="use the mM2E tokenizer?"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of encoding processes [%(default)d]",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=10000,
+        help="mentions per worker task [%(default)d]",
+    )
+    parser.add_argument(
+        "--tmp_dir",
+        type=str,
+        default=None,
+        help="directory for the sorted runs (default: next to the output)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.mention_to_candidates, "rb") as f:
+        mention_to_candidates_dict = pickle.load(f)
+
+    build_candidates_bundle(
+        mention_to_candidates_dict,
+        args.tokenizer,
+        args.output,
+        multilingual=args.multilingual,
+        processes=args.processes,
+        chunk_size=args.chunk_size,
+        tmp_dir=args.tmp_dir,
+    )
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import heapq
+import logging
+import os
+import tempfile
+import time
+
+from trie import ArrayTrie
+
+logger = logging.getLogger(__name__)
+
+
+def read_sequences(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield tuple(int(e) for e in line.split())
+
+
+def write_sequences(sequences, path):
+    with open(path, "w") as f:
+        for sequence in sequences:
+            f.write(" ".join(str(e) for e in sequence) + "\n")
+
+
+def log_progress(sequences, message, log_every=1000000):
+    start = time.time()
+    i = 0
+    for i, sequence in enumerate(sequences, 1):
+        if i % log_every == 0:
+            logger.info(
+                "{} {} sequences ({:.0f}s)".format(message, i, time.time() - start)
+            )
+        yield sequence
+    logger.info("{} {} sequences ({:.0f}s)".format(message, i, time.time() - start))
+
+
+def sort_sequences_external(sequences, tmp_dir, chunk_size=1000000):
+    runs = []
+    chunk = []
+    for sequence in log_progress(sequences, "read"):
+        chunk.append(tuple(sequence))
+        if len(chunk) == chunk_size:
+            runs.append(os.path.join(tmp_dir, "{}.run".format(len(runs))))
+            write_sequences(sorted(chunk), runs[-1])
+            chunk = []
+
+    if chunk:
+        runs.append(os.path.join(tmp_dir, "{}.run".format(len(runs))))
+        write_sequences(sorted(chunk), runs[-1])
+
+    logger.info("merging {} sorted runs".format(len(runs)))
+    return heapq.merge(*[read_sequences(e) for e in runs])
+
+
+def build_trie_file(sequences, output_path, chunk_size=1000000, tmp_dir=None):
+    with tempfile.TemporaryDirectory(
+        dir=tmp_dir or os.path.dirname(output_path) or None
+    ) as runs_dir:
+        ArrayTrie.save_sorted_to_file(
+            log_progress(
+                sort_sequences_external(sequences, runs_dir, chunk_size), "merged"
+            ),
+            output_path,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input",
+        type=str,
+        nargs="+",
+        help="files with one tokenized title per line (space separated token ids)",
+    )
+    parser.add_argument("--output", type=str, help="output `ArrayTrie` file")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1000000,
+        help="sequences sorted in memory at once [%(default)d]",
+    )
+    parser.add_argument(
+        "--tmp_dir",
+        type=str,
+        default=None,
+        help="directory for the sorted runs (default: next to the output)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    build_trie_file(
+        (sequence for path in args.input for sequence in read_sequences(path)),
+        args.output,
+        chunk_size=args.chunk_size,
+        tmp_dir=args.tmp_dir,
+    )
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import pickle
+import time
+
+from trie import MarisaMapping
+from utils import WIKIDATA_INDEX_FILES, get_redirect_closure
+
+logger = logging.getLogger(__name__)
+
+
+def build_wikidata_index(output_path, **dictionaries):
+    # `dictionaries` are the in-memory `lang_title2wikidataID`,
+    # `lang_redirect2title` and `label_or_alias2wikidataID`, by name
+    os.makedirs(output_path, exist_ok=True)
+    for name, dictionary in dictionaries.items():
+        filename, value_type = WIKIDATA_INDEX_FILES[name]
+        start = time.time()
+        if name == "lang_redirect2title":
+            num_redirects = len(dictionary)
+            dictionary = get_redirect_closure(dictionary)
+            logger.info(
+                "redirect chains collapsed, {} redirects in cycles dropped".format(
+                    num_redirects - len(dictionary)
+                )
+            )
+        MarisaMapping(dictionary.items(), value_type).save_to_file(
+            os.path.join(output_path, filename)
+        )
+        logger.info(
+            "{} with {} keys saved to {} ({:.0f}s)".format(
+                name, len(dictionary), filename, time.time() - start
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    for name in WIKIDATA_INDEX_FILES:
+        parser.add_argument(
+            "--{}".format(name), type=str, default=None, help="pickled dictionary"
+        )
+    parser.add_argument("--output", type=str, help="output directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for name in WIKIDATA_INDEX_FILES:
+        if getattr(args, name) is not None:
+            # one at a time, the pickled dictionaries are the large part
+            with open(getattr(args, name), "rb") as f:
+                build_wikidata_index(args.output, **{name: pickle.load(f)})
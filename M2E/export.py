@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+from typing import Dict, List
+
+import torch
+from torch import nn
+from transformers import BartTokenizer, XLMRobertaTokenizer
+from utils import constrained_beam_search, post_process_wikidata
+
+logger = logging.getLogger(__name__)
+
+
+class M2EEncoder(nn.Module):
+    # encoder of one sentence, returning the keys and values of the cross
+    # attention of every decoder layer, (layers, 1, heads, length, head_dim)
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+        self.cross_attentions = nn.ModuleList(
+            [layer.encoder_attn for layer in model.get_decoder().layers]
+        )
+
+    def forward(self, input_ids):
+        hidden_states = self.encoder(input_ids=input_ids)[0]
+        keys = []
+        values = []
+        for attention in self.cross_attentions:
+            keys.append(_split_heads(attention.k_proj(hidden_states), attention))
+            values.append(_split_heads(attention.v_proj(hidden_states), attention))
+        return torch.stack(keys), torch.stack(values)
+
+
+class M2EDecoderStep(nn.Module):
+    # one decoding step for a batch of beams: takes the last token of every
+    # beam, its position and the self / cross attention keys and values, and
+    # returns the next token log-probs and the self attention keys and values
+    # extended by one position
+    def __init__(self, model):
+        super().__init__()
+        decoder = model.get_decoder()
+        self.embed_tokens = decoder.embed_tokens
+        self.embed_positions = decoder.embed_positions
+        self.layernorm_embedding = decoder.layernorm_embedding
+        self.layers = decoder.layers
+        self.layer_norm = getattr(decoder, "layer_norm", None)
+        self.lm_head = model.lm_head
+        self.register_buffer("final_logits_bias", model.final_logits_bias.clone())
+
+        # mBART normalizes before every block and at the end, BART after every block
+        self.normalize_before = self.layer_norm is not None
+        self.embed_scale = (
+            1.0
+            if hasattr(decoder.embed_tokens, "embed_scale")
+            else getattr(decoder, "embed_scale", 1.0)
+        )
+        self.position_offset = getattr(decoder.embed_positions, "offset", 0)
+
+    def forward(
+        self, input_ids, position, self_keys, self_values, cross_keys, cross_values
+    ):
+        hidden_states = self.embed_tokens(input_ids) * self.embed_scale
+        hidden_states = hidden_states + self.embed_positions.weight[
+            position + self.position_offset
+        ].unsqueeze(0)
+        hidden_states = self.layernorm_embedding(hidden_states)
+
+        next_self_keys = []
+        next_self_values = []
+        for i, layer in enumerate(self.layers):
+            residual = hidden_states
+            if self.normalize_before:
+                hidden_states = layer.self_attn_layer_norm(hidden_states)
+            attention = layer.self_attn
+            keys = torch.cat(
+                (
+                    self_keys[i],
+                    _split_heads(attention.k_proj(hidden_states), attention),
+                ),
+                2,
+            )
+            values = torch.cat(
+                (
+                    self_values[i],
+                    _split_heads(attention.v_proj(hidden_states), attention),
+                ),
+                2,
+            )
+            next_self_keys.append(keys)
+            next_self_values.append(values)
+            hidden_states = residual + _attend(attention, hidden_states, keys, values)
+            if not self.normalize_before:
+                hidden_states = layer.self_attn_layer_norm(hidden_states)
+
+            residual = hidden_states
+            if self.normalize_before:
+                hidden_states = layer.encoder_attn_layer_norm(hidden_states)
+            hidden_states = residual + _attend(
+                layer.encoder_attn, hidden_states, cross_keys[i], cross_values[i]
+            )
+            if not self.normalize_before:
+                hidden_states = layer.encoder_attn_layer_norm(hidden_states)
+
+            residual = hidden_states
+            if self.normalize_before:
+                hidden_states = layer.final_layer_norm(hidden_states)
+            hidden_states = residual + layer.fc2(
+                layer.activation_fn(layer.fc1(hidden_states))
+            )
+            if not self.normalize_before:
+                hidden_states = layer.final_layer_norm(hidden_states)
+
+        if self.layer_norm is not None:
+            hidden_states = self.layer_norm(hidden_states)
+
+        logits = self.lm_head(hidden_states[:, -1]) + self.final_logits_bias
+        return (
+            logits.log_softmax(-1),
+            torch.stack(next_self_keys),
+            torch.stack(next_self_values),
+        )
+
+
+def _split_heads(states, attention):
+    batch_size, length, _ = states.shape
+    return states.view(
+        batch_size, length, attention.num_heads, attention.head_dim
+    ).transpose(1, 2)
+
+
+def _attend(attention, hidden_states, keys, values):
+    queries = _split_heads(
+        attention.q_proj(hidden_states) * attention.scaling, attention
+    )
+    weights = torch.matmul(queries, keys.transpose(2, 3)).softmax(-1)
+    outputs = torch.matmul(weights, values).transpose(1, 2)
+    return attention.out_proj(outputs.reshape(hidden_states.shape))
+
+
+def export_m2e(model, output_path, multilingual=False):
+    # traces encoder and decoder step with TorchScript, next to the tokenizer
+    # and the ids needed to decode
+    model = model.eval()
+    os.makedirs(output_path, exist_ok=True)
+
+    input_ids = torch.tensor(
+        [[model.config.bos_token_id, 4, 5, 6, model.config.eos_token_id]]
+    )
+    encoder = M2EEncoder(model)
+    with torch.no_grad():
+        traced_encoder = torch.jit.trace(encoder, (input_ids,))
+        cross_keys, cross_values = encoder(input_ids)
+
+        # traced with a past of one position, so that its length stays dynamic
+        self_keys = cross_keys[:, :, :, :1].expand(-1, 2, -1, -1, -1).contiguous()
+        self_values = cross_values[:, :, :, :1].expand(-1, 2, -1, -1, -1).contiguous()
+        traced_decoder_step = torch.jit.trace(
+            M2EDecoderStep(model),
+            (
+                torch.tensor([[4], [5]]),
+                torch.tensor([1]),
+                self_keys,
+                self_values,
+                cross_keys.expand(-1, 2, -1, -1, -1).contiguous(),
+                cross_values.expand(-1, 2, -1, -1, -1).contiguous(),
+            ),
+        )
+
+    traced_encoder.save(os.path.join(output_path, "encoder.pt"))
+    traced_decoder_step.save(os.path.join(output_path, "decoder_step.pt"))
+    model.tokenizer.save_pretrained(output_path)
+    with open(os.path.join(output_path, "config.json"), "w") as f:
+        json.dump(
+            {
+                "multilingual": multilingual,
+                "decoder_start_token_id": model.config.decoder_start_token_id,
+                "eos_token_id": model.config.eos_token_id,
+            },
+            f,
+        )
+
+
+class ExportedM2E(object):
+    def __init__(self, encoder, decoder_step, tokenizer, config):
+        self.encoder = encoder
+        self.decoder_step = decoder_step
+        self.tokenizer = tokenizer
+        self.config = config
+
+    @classmethod
+    def from_pretrained(cls, model_name_or_path):
+        with open(os.path.join(model_name_or_path, "config.json")) as f:
+            config = json.load(f)
+        return cls(
+            torch.jit.load(os.path.join(model_name_or_path, "encoder.pt")),
+            torch.jit.load(os.path.join(model_name_or_path, "decoder_step.pt")),
+            (
+                XLMRobertaTokenizer if config["multilingual"] else BartTokenizer
+            ).from_pretrained(model_name_or_path),
+            config,
+        )
+
+    def sample(
+        self,
+        sentences: List[str],
+        num_beams: int = 5,
+        num_return_sequences: int = 5,
+        text_to_id: Dict[str, str] = None,
+        marginalize: bool = False,
+        prefix_allowed_tokens_fn=None,
+        score_margin: float = float("inf"),
+        max_length: int = 1024,
+        length_penalty: float = 1.0,
+        early_stopping=False,
+        **kwargs
+    ) -> List[str]:
+        outputs = [
+            [
+                {
+                    "text": self.tokenizer.decode(sent, skip_special_tokens=True),
+                    "score": torch.tensor(score),
+                    "tokens": sent,
+                }
+                for score, sent in self._sample(
+                    sentence,
+                    batch_id,
+                    prefix_allowed_tokens_fn,
+                    num_beams,
+                    num_return_sequences,
+                    score_margin,
+                    max_length,
+                    length_penalty,
+                    early_stopping,
+                )
+            ]
+            for batch_id, sentence in enumerate(sentences)
+        ]
+
+        return post_process_wikidata(
+            outputs, text_to_id=text_to_id, marginalize=marginalize
+        )
+
+    @torch.no_grad()
+    def _sample(
+        self,
+        sentence,
+        batch_id,
+        prefix_allowed_tokens_fn,
+        num_beams,
+        num_return_sequences,
+        score_margin,
+        max_length,
+        length_penalty,
+        early_stopping,
+    ):
+        cross_keys, cross_values = self.encoder(
+            torch.tensor([self.tokenizer.encode(sentence)])
+        )
+        state = {
+            "self_keys": cross_keys[:, :, :, :0],
+            "self_values": cross_values[:, :, :, :0],
+        }
+
+        def decoder_step(tokens, beam_idx):
+            if beam_idx is not None:
+                beam_idx = torch.tensor(beam_idx)
+                state["self_keys"] = state["self_keys"].index_select(1, beam_idx)
+                state["self_values"] = state["self_values"].index_select(1, beam_idx)
+
+            log_probs, state["self_keys"], state["self_values"] = self.decoder_step(
+                torch.tensor([[e] for e in tokens]),
+                torch.tensor([state["self_keys"].shape[3]]),
+                state["self_keys"],
+                state["self_values"],
+                cross_keys.expand(-1, len(tokens), -1, -1, -1),
+                cross_values.expand(-1, len(tokens), -1, -1, -1),
+            )
+            return log_probs
+
+        if prefix_allowed_tokens_fn is None:
+            prefix_allowed_tokens_fn = lambda batch_id, sent: list(
+                range(len(self.tokenizer))
+            )
+
+        return constrained_beam_search(
+            decoder_step,
+            batch_id,
+            prefix_allowed_tokens_fn,
+            self.config["decoder_start_token_id"],
+            self.config["eos_token_id"],
+            num_beams=num_beams,
+            num_return_sequences=num_return_sequences,
+            score_margin=score_margin,
+            max_length=max_length,
+            length_penalty=length_penalty,
+            early_stopping=early_stopping,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, help="M2E model path")
+    parser.add_argument("--output", type=str, help="output directory")
+    parser.add_argument(
+        "--multilingual", action="store_true", help="export a mM2E model?"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from m2e_module import M2E, mM2E
+
+    export_m2e(
+        (mM2E if args.multilingual else M2E).from_pretrained(args.model),
+        args.output,
+        multilingual=args.multilingual,
+    )
+    logger.info("exported {} to {}".format(args.model, args.output))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import time
+from multiprocessing import Pool
+
+from utils import iter_pages
+
+logger = logging.getLogger(__name__)
+
+
+def _extract_file(paths):
+    input_path, output_path = paths
+    num_docs = 0
+    num_anchors = 0
+    # shards appear complete or not at all, so an interrupted run can resume
+    with open(output_path + ".tmp", "w") as f:
+        for doc in iter_pages(input_path):
+            f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            num_docs += 1
+            num_anchors += len(doc["anchors"])
+    os.replace(output_path + ".tmp", output_path)
+    return input_path, num_docs, num_anchors
+
+
+def extract_wikipedia(input_paths, output_path, processes=1):
+    # one jsonl shard of documents (with paragraphs and anchors) per
+    # WikiExtractor file, the files are spread over `processes` workers
+    os.makedirs(output_path, exist_ok=True)
+    jobs = [
+        (input_path, os.path.join(output_path, "{:05d}.jsonl".format(i)))
+        for i, input_path in enumerate(sorted(input_paths))
+    ]
+    jobs = [e for e in jobs if not os.path.exists(e[1])]
+    logger.info(
+        "{} files to extract, {} already done".format(
+            len(jobs), len(input_paths) - len(jobs)
+        )
+    )
+
+    start = time.time()
+    total_docs = 0
+    with Pool(processes) as pool:
+        for i, (input_path, num_docs, num_anchors) in enumerate(
+            pool.imap_unordered(_extract_file, jobs), 1
+        ):
+            total_docs += num_docs
+            logger.info(
+                "{}/{} {}: {} docs, {} anchors ({:.0f} docs/s)".format(
+                    i,
+                    len(jobs),
+                    input_path,
+                    num_docs,
+                    num_anchors,
+                    total_docs / (time.time() - start),
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input", type=str, nargs="+", help="WikiExtractor output files"
+    )
+    parser.add_argument("--output", type=str, help="output directory")
+    parser.add_argument(
+        "--processes", type=int, default=1, help="worker processes [%(default)d]"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    extract_wikipedia(args.input, args.output, args.processes)
@@ -3,18 +3,82 @@
 import torch
 import logging
 import os
+import time
 from typing import List, Dict
-from utils import chunk_it, post_process_wikidata
+from trie import TokenBitset
+from utils import (
+    chunk_it,
+    constrained_beam_search,
+    get_bucket_prefix_allowed_tokens_fn,
+    get_length_buckets,
+    get_padding_efficiency,
+    post_process_wikidata,
+)
 from fairseq.models.bart import BARTHubInterface, BARTModel
 from transformers import (
     BartTokenizer,
     BartForConditionalGeneration,
     XLMRobertaTokenizer,
     MBartForConditionalGeneration,
+    LogitsProcessor,
+    LogitsProcessorList,
 )
 
 logger = logging.getLogger(__name__)
 
+
+def quantize_dynamic(model):
+    # int8 weights for the linear layers of encoder and decoder, activations are
+    # quantized on the fly: CPU inference only. The output projection (`lm_head`,
+    # `output_projection` in fairseq) stays fp32, it is tied to the embeddings
+    # and ranks the whole vocabulary at every step
+    return torch.quantization.quantize_dynamic(
+        model,
+        {
+            name
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear)
+            and name.split(".")[-1] not in ("lm_head", "output_projection")
+        },
+        dtype=torch.qint8,
+    )
+
+
+class BatchedPrefixConstrainedLogitsProcessor(LogitsProcessor):
+    def __init__(self, prefix_allowed_tokens_fn, num_beams: int):
+        self._prefix_allowed_tokens_fn = getattr(
+            prefix_allowed_tokens_fn, "get_allowed_tokens", prefix_allowed_tokens_fn
+        )
+        self._num_beams = num_beams
+
+    def __call__(
+            self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        rows = []
+        cols = []
+        bitsets = {}
+        for i, sent in enumerate(input_ids.tolist()):
+            allowed = self._prefix_allowed_tokens_fn(i // self._num_beams, sent)
+            if isinstance(allowed, int):
+                allowed = [allowed]
+            if isinstance(allowed, TokenBitset):
+                bitsets.setdefault(id(allowed), (allowed, []))[1].append(i)
+            else:
+                rows += [i] * len(allowed)
+                cols += allowed
+
+        mask = torch.zeros_like(scores, dtype=torch.bool)
+        mask[
+            torch.tensor(rows, dtype=torch.long, device=scores.device),
+            torch.tensor(cols, dtype=torch.long, device=scores.device),
+        ] = True
+        for bitset, bitset_rows in bitsets.values():
+            mask[bitset_rows, : len(bitset.mask)] = torch.from_numpy(bitset.mask).to(
+                scores.device
+            )
+        return scores.masked_fill(~mask, -float("inf"))
+
+
 class _M2E_HubInterface:
     def sample(
             self,
@@ -23,8 +87,150 @@ class _M2E_HubInterface:
             num_return_sequences=5,
             text_to_id: Dict[str, str] = None,
             marginalize: bool = False,
+            batched_constraints: bool = False,
+            copy_speculation: bool = False,
+            max_draft_length: int = 32,
+            max_tokens: int = None,
+            score_margin: float = None,
+            max_len_a: float = None,
+            max_len_b: int = 16,
             **kwargs
     ) -> List[str]:
+        # times the whole call for the constraint stats, nested calls included
+        stats = getattr(kwargs.get("prefix_allowed_tokens_fn"), "stats", None)
+        if stats is not None and not stats.sampling:
+            stats.sampling = True
+            start = time.perf_counter()
+            try:
+                return self.sample(
+                    sentences,
+                    num_beams=num_beams,
+                    num_return_sequences=num_return_sequences,
+                    text_to_id=text_to_id,
+                    marginalize=marginalize,
+                    batched_constraints=batched_constraints,
+                    copy_speculation=copy_speculation,
+                    max_draft_length=max_draft_length,
+                    max_tokens=max_tokens,
+                    score_margin=score_margin,
+                    max_len_a=max_len_a,
+                    max_len_b=max_len_b,
+                    **kwargs
+                )
+            finally:
+                stats.sampling = False
+                stats.record_sample(time.perf_counter() - start)
+                logger.debug(stats)
+
+        if max_len_a is not None:
+            # outputs are the source plus the `{ } [ ]` markup and the titles
+            kwargs["max_length"] = min(
+                kwargs.get("max_length", 1024),
+                int(
+                    max_len_a
+                    * max(len(self.tokenizer.encode(sentence)) for sentence in sentences)
+                    + max_len_b
+                ),
+            )
+
+        if max_tokens is not None:
+            lengths = [len(self.tokenizer.encode(sentence)) for sentence in sentences]
+            buckets = get_length_buckets(lengths, max_tokens)
+            logger.info(
+                "{} sentences in {} buckets, padding efficiency {:.2%}".format(
+                    len(sentences),
+                    len(buckets),
+                    get_padding_efficiency(lengths, buckets),
+                )
+            )
+
+            outputs = [None] * len(sentences)
+            for bucket in buckets:
+                bucket_kwargs = dict(kwargs)
+                if kwargs.get("prefix_allowed_tokens_fn"):
+                    bucket_kwargs["prefix_allowed_tokens_fn"] = (
+                        get_bucket_prefix_allowed_tokens_fn(
+                            kwargs["prefix_allowed_tokens_fn"], bucket
+                        )
+                    )
+                for i, output in zip(
+                    bucket,
+                    self.sample(
+                        [sentences[i] for i in bucket],
+                        num_beams=num_beams,
+                        num_return_sequences=num_return_sequences,
+                        text_to_id=text_to_id,
+                        marginalize=marginalize,
+                        batched_constraints=batched_constraints,
+                        copy_speculation=copy_speculation,
+                        max_draft_length=max_draft_length,
+                        score_margin=score_margin,
+                        max_len_a=max_len_a,
+                        max_len_b=max_len_b,
+                        **bucket_kwargs
+                    ),
+                ):
+                    outputs[i] = output
+            return outputs
+
+        if copy_speculation:
+            if num_beams != 1 or not kwargs.get("prefix_allowed_tokens_fn"):
+                raise ValueError(
+                    "`copy_speculation` needs greedy decoding (`num_beams=1`) and a "
+                    "`prefix_allowed_tokens_fn`"
+                )
+            outputs = [
+                [
+                    self._sample_copy_speculative(
+                        sentence,
+                        batch_id,
+                        kwargs["prefix_allowed_tokens_fn"],
+                        max_length=kwargs.get("max_length", 1024),
+                        max_draft_length=max_draft_length,
+                    )
+                ]
+                for batch_id, sentence in enumerate(sentences)
+            ]
+            return post_process_wikidata(
+                outputs, text_to_id=text_to_id, marginalize=marginalize
+            )
+
+        if score_margin is not None:
+            if not kwargs.get("prefix_allowed_tokens_fn"):
+                raise ValueError("`score_margin` needs a `prefix_allowed_tokens_fn`")
+            # same hypotheses scoring and stopping as `generate`
+            generation_kwargs = {}
+            for key in ("length_penalty", "early_stopping"):
+                value = kwargs.get(key, getattr(self.generation_config, key, None))
+                if value is not None:
+                    generation_kwargs[key] = value
+            outputs = [
+                self._sample_adaptive_beam(
+                    sentence,
+                    batch_id,
+                    kwargs["prefix_allowed_tokens_fn"],
+                    num_beams=num_beams,
+                    num_return_sequences=num_return_sequences,
+                    score_margin=score_margin,
+                    max_length=kwargs.get("max_length", 1024),
+                    **generation_kwargs
+                )
+                for batch_id, sentence in enumerate(sentences)
+            ]
+            return post_process_wikidata(
+                outputs, text_to_id=text_to_id, marginalize=marginalize
+            )
+
+        if batched_constraints and kwargs.get("prefix_allowed_tokens_fn"):
+            kwargs["logits_processor"] = LogitsProcessorList(
+                list(kwargs.pop("logits_processor", []))
+                + [
+                    BatchedPrefixConstrainedLogitsProcessor(
+                        kwargs.pop("prefix_allowed_tokens_fn"), num_beams
+                    )
+                ]
+            )
+
         input_args = {
             k: v.to(self.device)
             for k, v in self.tokenizer.batch_encode_plus(
@@ -35,7 +241,7 @@ class _M2E_HubInterface:
         outputs = self.generate(
             **input_args,
             min_length=0,
-            max_length=1024,
+            max_length=kwargs.pop("max_length", 1024),
             num_beams=num_beams,
             num_return_sequences=num_return_sequences,
             output_scores=True,
@@ -45,12 +251,13 @@ class _M2E_HubInterface:
 
         outputs = chunk_it(
             [
-                {"text": text, "score": score, }
-                for text, score in zip(
+                {"text": text, "score": score, "tokens": tokens}
+                for text, score, tokens in zip(
                 self.tokenizer.batch_decode(
                     outputs.sequences, skip_special_tokens=True
                 ),
                 outputs.sequences_scores,
+                outputs.sequences.tolist(),
             )
             ],
             len(sentences),
@@ -62,6 +269,141 @@ class _M2E_HubInterface:
 
         return outputs
 
+    @torch.no_grad()
+    def _sample_copy_speculative(
+            self,
+            sentence: str,
+            batch_id: int,
+            prefix_allowed_tokens_fn,
+            max_length: int = 1024,
+            max_draft_length: int = 32,
+    ) -> Dict:
+        # Greedy constrained decoding where, outside of mentions, the rest of
+        # the source sentence is fed as a draft: one decoder call scores the
+        # whole draft, and tokens are accepted up to the first position where
+        # the constrained argmax differs from it (e.g. the model opens a `{`).
+        sent_orig = prefix_allowed_tokens_fn.sent_origs[batch_id]
+        input_ids = self.encode(sentence).unsqueeze(0).to(self.device)
+        encoder_outputs = self.get_encoder()(input_ids=input_ids)
+
+        sent = [self.config.decoder_start_token_id]
+        pending = list(sent)
+        past_key_values = None
+        score = 0.0
+        while len(sent) < max_length and pending:
+            status, pointer_end, _, _ = prefix_allowed_tokens_fn.get_state(
+                batch_id, sent
+            )
+            draft = (
+                sent_orig[pointer_end : pointer_end + max_draft_length]
+                if status == "o" and pointer_end
+                else []
+            )[: max_length - len(sent) - 1]
+
+            outputs = self(
+                encoder_outputs=encoder_outputs,
+                decoder_input_ids=torch.tensor([pending + draft], device=self.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            log_probs = outputs.logits[0, len(pending) - 1 :].log_softmax(-1)
+            past_key_values = outputs.past_key_values
+
+            pending = []
+            for i in range(len(draft) + 1):
+                allowed = prefix_allowed_tokens_fn(batch_id, sent)
+                if isinstance(allowed, int):
+                    allowed = [allowed]
+                if len(allowed) == 0:
+                    break
+                mask = torch.full_like(log_probs[i], -float("inf"))
+                mask[allowed] = 0
+                token = int((log_probs[i] + mask).argmax())
+                score += float(log_probs[i, token])
+                sent.append(token)
+                if token == self.config.eos_token_id or len(sent) >= max_length:
+                    break
+                elif i == len(draft) or token != draft[i]:
+                    pending = [token]
+                    break
+
+            # drop the rejected part of the draft from the self-attention cache
+            if hasattr(past_key_values, "crop"):
+                past_key_values.crop(len(sent) - 1)
+            else:
+                past_key_values = tuple(
+                    tuple(e[:, :, : len(sent) - 1] for e in layer[:2]) + layer[2:]
+                    for layer in past_key_values
+                )
+
+        return {
+            "text": self.tokenizer.decode(sent, skip_special_tokens=True),
+            "score": torch.tensor(score / len(sent)),
+            "tokens": sent,
+        }
+
+    @torch.no_grad()
+    def _sample_adaptive_beam(
+            self,
+            sentence: str,
+            batch_id: int,
+            prefix_allowed_tokens_fn,
+            num_beams: int = 5,
+            num_return_sequences: int = 5,
+            score_margin: float = 5.0,
+            max_length: int = 1024,
+            length_penalty: float = 1.0,
+            early_stopping=False,
+    ) -> List[Dict]:
+        # one sentence at a time, the beam changes size from step to step
+        input_ids = self.encode(sentence).unsqueeze(0).to(self.device)
+        encoder_hidden_states = self.get_encoder()(input_ids=input_ids)[0]
+        past_key_values = None
+
+        def decoder_step(tokens, beam_idx):
+            nonlocal past_key_values
+            if beam_idx is not None:
+                beam_idx = torch.tensor(beam_idx, device=self.device)
+                if hasattr(past_key_values, "reorder_cache"):
+                    past_key_values.reorder_cache(beam_idx)
+                else:
+                    past_key_values = tuple(
+                        tuple(e.index_select(0, beam_idx) for e in layer)
+                        for layer in past_key_values
+                    )
+
+            outputs = self(
+                encoder_outputs=(encoder_hidden_states.expand(len(tokens), -1, -1),),
+                decoder_input_ids=torch.tensor(
+                    [[e] for e in tokens], device=self.device
+                ),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+            return outputs.logits[:, -1].log_softmax(-1)
+
+        return [
+            {
+                "text": self.tokenizer.decode(sent, skip_special_tokens=True),
+                "score": torch.tensor(score),
+                "tokens": sent,
+            }
+            for score, sent in constrained_beam_search(
+                decoder_step,
+                batch_id,
+                prefix_allowed_tokens_fn,
+                self.config.decoder_start_token_id,
+                self.config.eos_token_id,
+                num_beams=num_beams,
+                num_return_sequences=num_return_sequences,
+                score_margin=score_margin,
+                max_length=max_length,
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+            )
+        ]
+
     def encode(self, sentence):
         return self.tokenizer.encode(sentence, return_tensors="pt")[0]
 
@@ -76,16 +418,20 @@ class m_M2EHubInterface(__BIELHubInterface, MBartForConditionalGeneration):
 
 class M2E(BartForConditionalGeneration):
     @classmethod
-    def from_pretrained(cls, model_name_or_path):
+    def from_pretrained(cls, model_name_or_path, quantize: bool = False):
         model = M2EHubInterface.from_pretrained(model_name_or_path)
+        if quantize:
+            model = quantize_dynamic(model)
         model.tokenizer = BartTokenizer.from_pretrained(model_name_or_path)
         return model
 
 
 class mM2E(MBartForConditionalGeneration):
     @classmethod
-    def from_pretrained(cls, model_name_or_path):
+    def from_pretrained(cls, model_name_or_path, quantize: bool = False):
         model = mM2EHubInterface.from_pretrained(model_name_or_path)
+        if quantize:
+            model = quantize_dynamic(model)
         model.tokenizer = XLMRobertaTokenizer.from_pretrained(model_name_or_path)
         return model
 
@@ -118,7 +464,11 @@ class _M2EHubInterface:
 
         outputs = [
             [
-                {"text": self.decode(hypo["tokens"]), "score": hypo["score"]}
+                {
+                    "text": self.decode(hypo["tokens"]),
+                    "score": hypo["score"],
+                    "tokens": hypo["tokens"].tolist(),
+                }
                 for hypo in hypos
             ]
             for hypos in batched_hypos
@@ -162,6 +512,7 @@ class M2E(BARTModel):
             checkpoint_file="model.pt",
             data_name_or_path=".",
             bpe="gpt2",
+            quantize=False,
             **kwargs,
     ):
         from fairseq import hub_utils
@@ -175,7 +526,11 @@ class M2E(BARTModel):
             load_checkpoint_heads=True,
             **kwargs,
         )
-        return M2EHubInterface(x["args"], x["task"], x["models"][0])
+        return M2EHubInterface(
+            x["args"],
+            x["task"],
+            quantize_dynamic(x["models"][0]) if quantize else x["models"][0],
+        )
 
 
 class mM2E(BARTModel):
@@ -188,6 +543,7 @@ class mM2E(BARTModel):
             data_name_or_path=".",
             bpe="sentencepiece",
             layernorm_embedding=True,
+            quantize=False,
             **kwargs,
     ):
         from fairseq import hub_utils
@@ -202,4 +558,8 @@ class mM2E(BARTModel):
             sentencepiece_model=os.path.join(model_name_or_path, sentencepiece_model),
             **kwargs,
         )
-        return mM2EHubInterface(x["args"], x["task"], x["models"][0])
+        return mM2EHubInterface(
+            x["args"],
+            x["task"],
+            quantize_dynamic(x["models"][0]) if quantize else x["models"][0],
+        )
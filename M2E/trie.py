@@ -2,8 +2,18 @@
 
 
 
+import copy
+import os
+import shutil
+import tempfile
+from array import array
+from collections import OrderedDict, deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from typing import Dict, List
 
+import numpy as np
+
 try:
     import marisa_trie
 except ModuleNotFoundError:
@@ -44,10 +54,10 @@ class Trie(object):
 
     @staticmethod
     def _add_to_trie(sequence: List[int], trie_dict: Dict):
-        if sequence:
-            if sequence[0] not in trie_dict:
-                trie_dict[sequence[0]] = {}
-            Trie._add_to_trie(sequence[1:], trie_dict[sequence[0]])
+        for token in sequence:
+            if token not in trie_dict:
+                trie_dict[token] = {}
+            trie_dict = trie_dict[token]
 
     @staticmethod
     def _get_from_trie(
@@ -56,50 +66,537 @@ class Trie(object):
         append_trie=None,
         bos_token_id: int = None,
     ):
-        if len(prefix_sequence) == 0:
-            output = list(trie_dict.keys())
-            if append_trie and bos_token_id in output:
-                output.remove(bos_token_id)
-                output += list(append_trie.trie_dict.keys())
-            return output
-        elif prefix_sequence[0] in trie_dict:
-            return Trie._get_from_trie(
-                prefix_sequence[1:],
-                trie_dict[prefix_sequence[0]],
-                append_trie,
-                bos_token_id,
-            )
-        else:
-            if append_trie:
-                return append_trie.get(prefix_sequence)
+        for i, token in enumerate(prefix_sequence):
+            if token in trie_dict:
+                trie_dict = trie_dict[token]
+            elif append_trie:
+                return append_trie.get(prefix_sequence[i:])
             else:
                 return []
 
+        output = list(trie_dict.keys())
+        if append_trie and bos_token_id in output:
+            output.remove(bos_token_id)
+            output += list(append_trie.trie_dict.keys())
+        return output
+
     def __iter__(self):
-        def _traverse(prefix_sequence, trie_dict):
+        stack = [([], self.trie_dict)]
+        while stack:
+            prefix_sequence, trie_dict = stack.pop()
             if trie_dict:
-                for next_token in trie_dict:
-                    yield from _traverse(
-                        prefix_sequence + [next_token], trie_dict[next_token]
+                for next_token in reversed(list(trie_dict)):
+                    stack.append(
+                        (prefix_sequence + [next_token], trie_dict[next_token])
                     )
             else:
                 yield prefix_sequence
 
-        return _traverse([], self.trie_dict)
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, value):
+        return self.get(value)
+
+
+class ArrayTrie(object):
+    _MAGIC = 0x31454952545241  # b"ARTRIE1"
+    _HEADER_SIZE = 8
+
+    def __init__(self, sequences: List[List[int]] = []):
+        self.len = 0
+        self._pending = []
+        self._source = None
+        # any iterable, as `Trie`: counted once sorted
+        sequences = sorted(tuple(e) for e in sequences)
+        self._set_arrays(*ArrayTrie._build_arrays(sequences))
+        self.len = len(sequences)
+
+        self.append_trie = None
+        self.bos_token_id = None
+
+    def append(self, trie, bos_token_id):
+        self.append_trie = trie
+        self.bos_token_id = bos_token_id
+
+    def add(self, sequence: List[int]):
+        self._pending.append(tuple(sequence))
+        self.len += 1
+
+    def get(self, prefix_sequence: List[int]):
+        self._flush()
+        node = self.root
+        for i, token in enumerate(prefix_sequence):
+            node = self._get_child(node, token)
+            if node < 0:
+                if self.append_trie:
+                    return self.append_trie.get(prefix_sequence[i:])
+                else:
+                    return []
+
+        output = self.tokens[self.offsets[node] : self.offsets[node + 1]].tolist()
+        if self.append_trie and self.bos_token_id in output:
+            output.remove(self.bos_token_id)
+            output += self.append_trie.get([])
+        return output
+
+    def get_subtrie(self, prefix_sequence: List[int]):
+        self._flush()
+        node = self.root
+        for token in prefix_sequence:
+            node = self._get_child(node, token)
+            if node < 0:
+                return None
+
+        trie = copy.copy(self)
+        trie.root = node
+        trie.len = None
+        trie._pending = []
+        trie.append_trie = None
+        trie.bos_token_id = None
+        return trie
+
+    def save_to_file(self, path: str):
+        with open(path, "wb") as f:
+            for values in self._get_buffer_arrays():
+                values.tofile(f)
+
+    def save_to_shared_memory(self, name: str = None):
+        arrays = self._get_buffer_arrays()
+        shared_memory = SharedMemory(
+            name=name, create=True, size=sum(e.nbytes for e in arrays)
+        )
+        start = 0
+        for values in arrays:
+            np.ndarray(
+                values.shape, dtype=values.dtype, buffer=shared_memory.buf, offset=start
+            )[:] = values
+            start += values.nbytes
+        return shared_memory
+
+    @staticmethod
+    def save_sorted_to_file(sorted_sequences, path: str, buffer_size: int = 1 << 20):
+        # streams lexicographically sorted sequences to an `ArrayTrie` file,
+        # keeping only the open path and `buffer_size` edges in memory
+        num_sequences = 0
+        num_nodes = 0
+        num_edges = 0
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or None) as tmp_dir:
+            buffers = {
+                "offsets": array("q", [0]),
+                "targets": array("q"),
+                "tokens": array("i"),
+            }
+            files = {name: open(os.path.join(tmp_dir, name), "w+b") for name in buffers}
+
+            def _counted(sequences):
+                # repeated sequences (sorted, so next to each other) count once
+                nonlocal num_sequences
+                previous = None
+                for sequence in sequences:
+                    if sequence == previous:
+                        continue
+                    num_sequences += 1
+                    previous = sequence
+                    yield sequence
+
+            for edges in ArrayTrie._iter_nodes(_counted(sorted_sequences)):
+                for token, target in edges:
+                    buffers["tokens"].append(token)
+                    buffers["targets"].append(target)
+                num_nodes += 1
+                num_edges += len(edges)
+                buffers["offsets"].append(num_edges)
+
+                if len(buffers["offsets"]) + len(buffers["tokens"]) >= buffer_size:
+                    for name, values in buffers.items():
+                        values.tofile(files[name])
+                        del values[:]
+
+            header = np.array(
+                [
+                    ArrayTrie._MAGIC,
+                    1,
+                    num_nodes,
+                    num_edges,
+                    num_nodes - 1,
+                    num_sequences,
+                    0,
+                    0,
+                ],
+                dtype=np.int64,
+            )
+            with open(path, "wb") as f:
+                header.tofile(f)
+                for name in ("offsets", "targets", "tokens"):
+                    buffers[name].tofile(files[name])
+                    files[name].seek(0)
+                    shutil.copyfileobj(files[name], f)
+                    files[name].close()
+
+    @staticmethod
+    def load_from_file(path: str):
+        trie = ArrayTrie._load_from_buffer(np.memmap(path, dtype=np.uint8, mode="r"))
+        trie._source = ("file", path)
+        return trie
+
+    @staticmethod
+    def load_from_shared_memory(name: str):
+        try:
+            shared_memory = SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13 attaching also registers the segment, and the
+            # resource tracker would unlink it when this process exits
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args, **kwargs: None
+            try:
+                shared_memory = SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+
+        trie = ArrayTrie._load_from_buffer(
+            np.ndarray((shared_memory.size,), dtype=np.uint8, buffer=shared_memory.buf)
+        )
+        trie._source = ("shared_memory", name)
+        trie._shared_memory = shared_memory
+        return trie
+
+    def _get_buffer_arrays(self):
+        self._flush()
+        header = np.array(
+            [
+                ArrayTrie._MAGIC,
+                1,
+                len(self.offsets) - 1,
+                len(self.tokens),
+                self.root,
+                len(self),
+                0,
+                0,
+            ],
+            dtype=np.int64,
+        )
+        return [
+            header,
+            np.ascontiguousarray(self.offsets, dtype=np.int64),
+            np.ascontiguousarray(self.targets, dtype=np.int64),
+            np.ascontiguousarray(self.tokens, dtype=np.int32),
+        ]
+
+    @staticmethod
+    def _load_from_buffer(buffer):
+        header = buffer[: 8 * ArrayTrie._HEADER_SIZE].view(np.int64)
+        if header[0] != ArrayTrie._MAGIC:
+            raise ValueError("Not an `ArrayTrie` buffer")
+        num_nodes, num_edges, root, length = (int(e) for e in header[2:6])
+
+        start = 8 * ArrayTrie._HEADER_SIZE
+        arrays = []
+        for size, dtype in (
+            (num_nodes + 1, np.int64),
+            (num_edges, np.int64),
+            (num_edges, np.int32),
+        ):
+            end = start + size * np.dtype(dtype).itemsize
+            arrays.append(buffer[start:end].view(dtype))
+            start = end
+
+        trie = ArrayTrie()
+        trie._set_arrays(arrays[0], arrays[2], arrays[1], root)
+        trie.len = length
+        return trie
+
+    @staticmethod
+    def _iter_nodes(sorted_sequences):
+        # Nodes are numbered in the order they are closed (post-order), so a
+        # single pass over lexicographically sorted sequences is enough to emit
+        # every node together with its (already numbered) children.
+        path = []
+        stack = [[]]
+        node_id = 0
+        previous = None
+        for sequence in sorted_sequences:
+            if previous is not None and sequence < previous:
+                raise ValueError("Sequences must be sorted")
+            previous = sequence
+
+            common = 0
+            while (
+                common < len(path)
+                and common < len(sequence)
+                and path[common] == sequence[common]
+            ):
+                common += 1
+
+            while len(path) > common:
+                yield stack.pop()
+                stack[-1].append((path.pop(), node_id))
+                node_id += 1
+
+            for token in sequence[common:]:
+                path.append(token)
+                stack.append([])
+
+        while path:
+            yield stack.pop()
+            stack[-1].append((path.pop(), node_id))
+            node_id += 1
+
+        yield stack.pop()
+
+    @staticmethod
+    def _build_arrays(sorted_sequences):
+        offsets = array("q", [0])
+        tokens = array("i")
+        targets = array("q")
+        for edges in ArrayTrie._iter_nodes(sorted_sequences):
+            for token, target in edges:
+                tokens.append(token)
+                targets.append(target)
+            offsets.append(len(tokens))
+
+        return (
+            np.frombuffer(offsets, dtype=np.int64),
+            np.frombuffer(tokens, dtype=np.int32),
+            np.frombuffer(targets, dtype=np.int64),
+            len(offsets) - 2,
+        )
+
+    def __getstate__(self):
+        # tries loaded from a file or a shared memory segment are pickled as a
+        # reference to it, so worker processes map the same pages
+        state = self.__dict__.copy()
+        state.pop("_shared_memory", None)
+        if state.get("_source") is not None and not self._pending:
+            for e in ("offsets", "tokens", "targets"):
+                del state[e]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "offsets" not in state:
+            kind, location = state["_source"]
+            if kind == "file":
+                trie = ArrayTrie.load_from_file(location)
+            else:
+                trie = ArrayTrie.load_from_shared_memory(location)
+            self.offsets = trie.offsets
+            self.tokens = trie.tokens
+            self.targets = trie.targets
+            if hasattr(trie, "_shared_memory"):
+                self._shared_memory = trie._shared_memory
+
+    def _set_arrays(self, offsets, tokens, targets, root):
+        self.offsets = offsets
+        self.tokens = tokens
+        self.targets = targets
+        self.root = root
+
+    def _flush(self):
+        if self._pending:
+            sequences = sorted(
+                set(tuple(e) for e in self._iter_leaves()).union(self._pending)
+            )
+            self._set_arrays(*ArrayTrie._build_arrays(sequences))
+            self._pending = []
+            self._source = None
+
+    def _get_child(self, node, token):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        index = start + np.searchsorted(self.tokens[start:end], token)
+        if index < end and self.tokens[index] == token:
+            return int(self.targets[index])
+        return -1
+
+    def _iter_leaves(self):
+        stack = [(self.root, [])]
+        while stack:
+            node, prefix_sequence = stack.pop()
+            start, end = self.offsets[node], self.offsets[node + 1]
+            if start == end:
+                yield prefix_sequence
+            for index in range(end - 1, start - 1, -1):
+                stack.append(
+                    (
+                        int(self.targets[index]),
+                        prefix_sequence + [int(self.tokens[index])],
+                    )
+                )
+
+    def __iter__(self):
+        self._flush()
+        return self._iter_leaves()
 
     def __len__(self):
+        if self.len is None:
+            self.len = sum(1 for _ in self)
         return self.len
 
     def __getitem__(self, value):
         return self.get(value)
 
 
+class CandidatesTrieBundle(object):
+    SEPARATOR = -1
+
+    def __init__(self, trie: ArrayTrie):
+        self.trie = trie
+        self.default_trie = trie.get_subtrie([CandidatesTrieBundle.SEPARATOR])
+
+    def get(self, mention_sequence: List[int]):
+        trie = self.trie.get_subtrie(
+            list(mention_sequence) + [CandidatesTrieBundle.SEPARATOR]
+        )
+        return trie if trie is not None else self.default_trie
+
+    @staticmethod
+    def get_sequences(mention_sequence, candidates_sequences):
+        return [
+            tuple(mention_sequence) + (CandidatesTrieBundle.SEPARATOR,) + tuple(e)
+            for e in candidates_sequences
+        ]
+
+    @staticmethod
+    def load_from_file(path: str):
+        return CandidatesTrieBundle(ArrayTrie.load_from_file(path))
+
+    def __len__(self):
+        return len(self.trie)
+
+
+class TrieRegistry(object):
+    # mention trie and candidates (bundle or trie) of every language, mapped
+    # from `ArrayTrie` files on first use; when the mapped files go over
+    # `max_memory` bytes the least recently used languages are dropped (their
+    # pages stay mapped while a prefix function still holds them)
+    def __init__(
+        self,
+        mention_trie_path: str = None,
+        candidates_path: str = None,
+        candidates_bundle: bool = True,
+        max_memory: int = 8 << 30,
+    ):
+        # paths are formatted with the language, e.g. "tries/{lang}.mention.bin"
+        self.mention_trie_path = mention_trie_path
+        self.candidates_path = candidates_path
+        self.candidates_bundle = candidates_bundle
+        self.max_memory = max_memory
+        self.memory = 0
+        self.loads = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, lang: str):
+        # keyword arguments of the prefix allowed tokens function factories
+        if lang in self._data:
+            self._data.move_to_end(lang)
+            return self._data[lang][0]
+
+        tries = {}
+        size = 0
+        for name, path in (
+            ("mention_trie", self.mention_trie_path),
+            (
+                "candidates_bundle" if self.candidates_bundle else "candidates_trie",
+                self.candidates_path,
+            ),
+        ):
+            if path is not None and os.path.isfile(path.format(lang=lang)):
+                trie = ArrayTrie.load_from_file(path.format(lang=lang))
+                tries[name] = (
+                    CandidatesTrieBundle(trie) if name == "candidates_bundle" else trie
+                )
+                size += os.path.getsize(path.format(lang=lang))
+
+        self._data[lang] = (tries, size)
+        self.memory += size
+        self.loads += 1
+        while self.memory > self.max_memory and len(self._data) > 1:
+            _, (_, size) = self._data.popitem(last=False)
+            self.memory -= size
+            self.evictions += 1
+
+        return tries
+
+    def clear(self):
+        self._data.clear()
+        self.memory = 0
+
+    def __contains__(self, lang):
+        return lang in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class AhoCorasick(object):
+    def __init__(self, sequences: List[List[int]] = []):
+        # goto function of the automaton (a trie), failure links and, for every
+        # node, the lengths of all the sequences that end there
+        self.goto = [{}]
+        self.fail = [0]
+        self.lengths = [()]
+        self.len = 0
+        for sequence in sequences:
+            self._add(sequence)
+        self._build()
+
+    @staticmethod
+    def from_mention_trie(mention_trie, eos_token_id: int):
+        # mentions are stored followed by `eos_token_id`, which marks them as
+        # complete: only these sequences are patterns of the automaton
+        return AhoCorasick(
+            sequence[:-1]
+            for sequence in mention_trie
+            if len(sequence) > 1 and sequence[-1] == eos_token_id
+        )
+
+    def find(self, sequence: List[int]):
+        node = 0
+        for i, token in enumerate(sequence):
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+            for length in self.lengths[node]:
+                yield i + 1 - length, i + 1
+
+    def _add(self, sequence: List[int]):
+        node = 0
+        for token in sequence:
+            if token not in self.goto[node]:
+                self.goto[node][token] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.lengths.append(())
+            node = self.goto[node][token]
+        if node and not self.lengths[node]:
+            self.lengths[node] = (len(sequence),)
+            self.len += 1
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                if node:
+                    self.fail[child] = self.goto[fail].get(token, 0)
+                self.lengths[child] += self.lengths[self.fail[child]]
+                queue.append(child)
+
+    def __len__(self):
+        return self.len
+
+
 class MarisaTrie(object):
     def __init__(
         self,
         sequences: List[List[int]] = [],
         cache_fist_branch=True,
         max_token_id=256001,
+        child_index=True,
     ):
 
         self.int2char = [chr(i) for i in range(min(max_token_id, 55000))] + (
@@ -109,17 +606,29 @@ class MarisaTrie(object):
         )
         self.char2int = {self.int2char[i]: i for i in range(max_token_id)}
 
-        self.cache_fist_branch = cache_fist_branch
+        # the child index already answers the first two levels in O(children)
+        self.cache_fist_branch = cache_fist_branch and not child_index
         if self.cache_fist_branch:
             self.zero_iter = list({sequence[0] for sequence in sequences})
             assert len(self.zero_iter) == 1
             self.first_iter = list({sequence[1] for sequence in sequences})
 
-        self.trie = marisa_trie.Trie(
-            "".join([self.int2char[i] for i in sequence]) for sequence in sequences
+        keys = sorted({"".join([self.int2char[i] for i in e]) for e in sequences})
+        self.trie = marisa_trie.Trie(keys)
+        self.children = (
+            marisa_trie.RecordTrie("<I", MarisaTrie._iter_edges(keys, self.char2int))
+            if child_index
+            else None
         )
 
     def get(self, prefix_sequence: List[int]):
+        if getattr(self, "children", None) is None:
+            return self._get_from_keys(prefix_sequence)
+
+        key = "".join([self.int2char[i] for i in prefix_sequence])
+        return [e for e, in self.children.get(key, [])]
+
+    def _get_from_keys(self, prefix_sequence: List[int]):
         if self.cache_fist_branch and len(prefix_sequence) == 0:
             return self.zero_iter
         elif (
@@ -138,6 +647,21 @@ class MarisaTrie(object):
                 }
             )
 
+    @staticmethod
+    def _iter_edges(sorted_keys, char2int):
+        previous = ""
+        for key in sorted_keys:
+            common = 0
+            while (
+                common < len(previous)
+                and common < len(key)
+                and previous[common] == key[common]
+            ):
+                common += 1
+            for i in range(common, len(key)):
+                yield key[:i], (char2int[key[i]],)
+            previous = key
+
     def __iter__(self):
         for sequence in self.trie.iterkeys():
             yield [self.char2int[e] for e in sequence]
@@ -149,6 +673,93 @@ class MarisaTrie(object):
         return self.get(value)
 
 
+class MarisaMapping(object):
+    # read-only replacement of the wikidata dictionaries (`lang_title2wikidataID`,
+    # `lang_redirect2title`, `label_or_alias2wikidataID`) on a marisa trie that
+    # can be memory mapped: keys are strings or `(lang, title)` tuples, values
+    # lists of wikidata ids (stored as integers) or strings
+    SEPARATOR = "\t"
+
+    def __init__(self, items=(), value_type: str = "ids"):
+        assert value_type in ("ids", "str"), value_type
+        self.value_type = value_type
+        if value_type == "ids":
+            self.trie = marisa_trie.RecordTrie(
+                "<I",
+                (
+                    (MarisaMapping._get_key(key), (int(e[1:]),))
+                    for key, values in items
+                    for e in values
+                ),
+            )
+        else:
+            self.trie = marisa_trie.BytesTrie(
+                (MarisaMapping._get_key(key), value.encode("utf-8"))
+                for key, value in items
+            )
+
+    def get(self, key, default=None):
+        values = self.trie.get(MarisaMapping._get_key(key))
+        if values is None:
+            return default
+        if self.value_type == "ids":
+            return ["Q{}".format(e) for e, in values]
+        return values[0].decode("utf-8")
+
+    def get_many(self, keys, default=None):
+        return [self.get(key, default) for key in keys]
+
+    def save_to_file(self, path: str):
+        self.trie.save(path)
+
+    @staticmethod
+    def load_from_file(path: str, value_type: str = "ids"):
+        # mapped, not read: pages are loaded on first access and shared
+        mapping = MarisaMapping(value_type=value_type)
+        mapping.trie.mmap(path)
+        return mapping
+
+    @staticmethod
+    def _get_key(key):
+        return MarisaMapping.SEPARATOR.join(key) if isinstance(key, tuple) else key
+
+    def __contains__(self, key):
+        return MarisaMapping._get_key(key) in self.trie
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+class TokenBitset(object):
+    def __init__(self, vocabulary_length: int, excluded_tokens: List[int] = ()):
+        self.mask = np.ones(vocabulary_length, dtype=bool)
+        self.mask[list(excluded_tokens)] = False
+        self._tokens = None
+
+    def difference(self, tokens: List[int]):
+        bitset = TokenBitset(0)
+        bitset.mask = self.mask.copy()
+        bitset.mask[list(tokens)] = False
+        return bitset
+
+    def tolist(self):
+        if self._tokens is None:
+            self._tokens = np.flatnonzero(self.mask).tolist()
+        return self._tokens
+
+    def __contains__(self, token):
+        return 0 <= token < len(self.mask) and bool(self.mask[token])
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __len__(self):
+        return len(self.tolist())
+
+
 class DummyTrieMention(object):
     def __init__(self, return_values):
         self._return_values = return_values
@@ -159,28 +770,24 @@ class DummyTrieMention(object):
 
 class DummyTrieEntity(object):
     def __init__(self, return_values, codes):
-        self._return_values = list(
-            set(return_values).difference(
-                set(
-                    codes[e]
-                    for e in (
-                        "start_mention_token",
-                        "end_mention_token",
-                        "start_entity_token",
-                    )
-                )
-            )
+        excluded_tokens = set(
+            codes[e]
+            for e in ("start_mention_token", "end_mention_token", "start_entity_token")
         )
+        if isinstance(return_values, TokenBitset):
+            self._return_values = return_values.difference(excluded_tokens)
+        else:
+            self._return_values = list(set(return_values).difference(excluded_tokens))
         self._codes = codes
 
     def get(self, indices, depth=0):
-        if len(indices) == 0 and depth == 0:
+        if len(indices) > 0 and indices[-1] == self._codes["end_entity_token"]:
+            return self._codes["EOS"]
+
+        depth += len(indices)
+        if depth == 0:
             return self._codes["end_mention_token"]
-        elif len(indices) == 0 and depth == 1:
+        elif depth == 1:
             return self._codes["start_entity_token"]
-        elif len(indices) == 0:
-            return self._return_values
-        elif len(indices) == 1 and indices[0] == self._codes["end_entity_token"]:
-            return self._codes["EOS"]
         else:
-            return self.get(indices[1:], depth=depth + 1)
+            return self._return_values
@@ -1,15 +1,31 @@
 # -*- coding: utf-8 -*-
 
 
+import hashlib
 import html
+import json
+import os
 import re
+import sqlite3
+import time
 import xml.etree.ElementTree as ET
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from urllib.parse import unquote
 from typing import Dict, List
+import numpy as np
 import torch
-from trie import DummyTrieEntity, DummyTrieMention, Trie
-from bs4 import BeautifulSoup
+from trie import (
+    AhoCorasick,
+    ArrayTrie,
+    CandidatesTrieBundle,
+    DummyTrieEntity,
+    DummyTrieMention,
+    MarisaMapping,
+    MarisaTrie,
+    TokenBitset,
+    Trie,
+)
 
 
 def get_end_to_end_prefix_allowed_tokens_fn_hf(
@@ -22,6 +38,11 @@ def get_end_to_end_prefix_allowed_tokens_fn_hf(
     mention_trie: Trie = None,
     candidates_trie: Trie = None,
     mention_to_candidates_dict: Dict[str, List[str]] = None,
+    incremental: bool = False,
+    candidates_trie_cache: "LRUCache" = None,
+    candidates_bundle: CandidatesTrieBundle = None,
+    mention_automaton: AhoCorasick = None,
+    stats: "ConstraintStats" = None,
 ):
     return _get_end_to_end_prefix_allowed_tokens_fn(
         lambda x: model.tokenizer.encode(x),
@@ -38,6 +59,11 @@ def get_end_to_end_prefix_allowed_tokens_fn_hf(
         mention_trie,
         candidates_trie,
         mention_to_candidates_dict,
+        incremental,
+        candidates_trie_cache,
+        candidates_bundle,
+        mention_automaton,
+        stats,
     )
 
 
@@ -51,6 +77,11 @@ def get_end_to_end_prefix_allowed_tokens_fn_fairseq(
     mention_trie: Trie = None,
     candidates_trie: Trie = None,
     mention_to_candidates_dict: Dict[str, List[str]] = None,
+    incremental: bool = False,
+    candidates_trie_cache: "LRUCache" = None,
+    candidates_bundle: CandidatesTrieBundle = None,
+    mention_automaton: AhoCorasick = None,
+    stats: "ConstraintStats" = None,
 ):
     return _get_end_to_end_prefix_allowed_tokens_fn(
         lambda x: model.encode(x).tolist(),
@@ -67,6 +98,11 @@ def get_end_to_end_prefix_allowed_tokens_fn_fairseq(
         mention_trie,
         candidates_trie,
         mention_to_candidates_dict,
+        incremental,
+        candidates_trie_cache,
+        candidates_bundle,
+        mention_automaton,
+        stats,
     )
 
 
@@ -85,11 +121,20 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
     mention_trie: Trie = None,
     candidates_trie: Trie = None,
     mention_to_candidates_dict: Dict[str, List[str]] = None,
+    incremental: bool = False,
+    candidates_trie_cache: "LRUCache" = None,
+    candidates_bundle: CandidatesTrieBundle = None,
+    mention_automaton: AhoCorasick = None,
+    stats: "ConstraintStats" = None,
 ):
 
-    assert not (
-        candidates_trie is not None and mention_to_candidates_dict is not None
-    ), "`candidates_trie` and `mention_to_candidates_dict` cannot be both != `None`"
+    assert (
+        sum(
+            e is not None
+            for e in (candidates_trie, mention_to_candidates_dict, candidates_bundle)
+        )
+        <= 1
+    ), "only one of `candidates_trie`, `mention_to_candidates_dict` and `candidates_bundle` can be != `None`"
 
     codes = {
         n: encode_fn(" {}".format(c))[1]
@@ -111,45 +156,161 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
     codes["EOS"] = eos_token_id
 
     if mention_trie is None:
-        mention_trie = DummyTrieMention(
-            [
-                i
-                for i in range(vocabulary_length)
-                if i not in (bos_token_id, pad_token_id,)
-            ]
+        mention_trie = _get_dummy_trie_mention(
+            vocabulary_length, bos_token_id, pad_token_id
         )
 
-    if candidates_trie is None and mention_to_candidates_dict is None:
-        candidates_trie = DummyTrieEntity(
-            [
-                i
-                for i in range(vocabulary_length)
-                if i not in (bos_token_id, pad_token_id,)
-            ],
-            codes,
+    if (
+        candidates_trie is None
+        and mention_to_candidates_dict is None
+        and candidates_bundle is None
+    ):
+        candidates_trie = _get_dummy_trie_entity(
+            vocabulary_length, bos_token_id, pad_token_id, tuple(sorted(codes.items()))
         )
 
+    if candidates_trie_cache is None:
+        candidates_trie_cache = LRUCache()
+
+    # lookups are only counted through wrappers, nothing changes without stats
+    if stats is not None:
+        mention_trie = _CountingTrie(mention_trie, stats, "mention")
+        if candidates_trie is not None:
+            candidates_trie = _CountingTrie(candidates_trie, stats, "candidates")
+        if candidates_bundle is not None:
+            candidates_bundle = _CountingTrie(candidates_bundle, stats, "candidates")
+        if mention_to_candidates_dict is not None:
+            candidates_trie_cache = _CountingCandidatesTrieCache(
+                candidates_trie_cache, stats
+            )
+
+    # dictionaries from `get_mention_ids_to_candidates_dict` are looked up with
+    # the mention token ids directly, without decoding them
+    mention_ids_keys = mention_to_candidates_dict is not None and isinstance(
+        next(iter(mention_to_candidates_dict), None), tuple
+    )
+
     sent_origs = [[codes["EOS"]] + encode_fn(sent)[1:] for sent in sentences]
 
+    # for every source position where a complete mention starts, the positions
+    # where it can end: mentions are only opened and closed at those
+    mention_ends = None
+    if mention_automaton is not None:
+        mention_ends = []
+        for sent_orig in sent_origs:
+            mention_ends.append(defaultdict(set))
+            for start, end in mention_automaton.find(sent_orig):
+                mention_ends[-1][start].add(end)
+
+    special_tokens = {
+        codes[e]
+        for e in (
+            "start_mention_token",
+            "end_mention_token",
+            "start_entity_token",
+            "end_entity_token",
+        )
+    }
+
     def prefix_allowed_tokens_fn(batch_id, sent):
+        trie_out = get_allowed_tokens(batch_id, sent)
+        if isinstance(trie_out, TokenBitset):
+            return trie_out.tolist()
+        return trie_out
+
+    def get_allowed_tokens(batch_id, sent):
 
-        sent = sent.tolist()
-        status = get_status(sent)
+        if not isinstance(sent, list):
+            sent = sent.tolist()
         sent_orig = sent_origs[batch_id]
 
+        if incremental:
+            status, pointer_end, pointer_start, pointer_end_mention = get_state(
+                batch_id, sent
+            )
+        else:
+            status = get_status(sent)
+            if status != "o":
+                pointer_start, pointer_end_mention = get_pointer_mention(sent)
+            if status != "e":
+                pointer_end = get_pointer_end(sent, sent_orig)
+
         if status == "o":
-            trie_out = get_trie_outside(sent, sent_orig)
+            trie_out = get_trie_outside(batch_id, sent_orig, pointer_end)
         elif status == "m":
-            trie_out = get_trie_mention(sent, sent_orig)
+            trie_out = get_trie_mention(
+                batch_id, sent, sent_orig, pointer_start, pointer_end
+            )
         elif status == "e":
-            trie_out = get_trie_entity(sent, sent_orig)
+            trie_out = get_trie_entity(sent, pointer_start, pointer_end_mention)
             if trie_out == codes["EOS"]:
-                trie_out = get_trie_outside(sent, sent_orig)
+                if not incremental:
+                    pointer_end = get_pointer_end(sent, sent_orig)
+                trie_out = get_trie_outside(batch_id, sent_orig, pointer_end)
         else:
             raise RuntimeError
 
         return trie_out
 
+    # states of the beams at the last two decoding steps, keyed by
+    # (batch_id, prefix), so every step only extends its parent by one token
+    states = {"length": 0, "current": {}, "previous": {}}
+
+    def get_state(batch_id, sent):
+        if len(sent) == states["length"] + 1:
+            states["previous"] = states["current"]
+            states["current"] = {}
+        elif len(sent) != states["length"]:
+            states["previous"] = {}
+            states["current"] = {}
+        states["length"] = len(sent)
+
+        key = (batch_id, tuple(sent))
+        state = states["current"].get(key)
+        if state is None:
+            sent_orig = sent_origs[batch_id]
+            state = states["previous"].get((batch_id, key[1][:-1]))
+            if state is not None:
+                state = extend_state(state, len(sent) - 1, sent[-1], sent_orig)
+            else:
+                state = (0, 0, False, None, -1)
+                for i, e in enumerate(sent):
+                    state = extend_state(state, i, e, sent_orig)
+            states["current"][key] = state
+
+        num_special, pointer, _, pointer_start, pointer_end_mention = state
+        return (
+            ("o", "m", "e", "e")[num_special % 4],
+            pointer if pointer != len(sent_origs[batch_id]) else None,
+            pointer_start,
+            pointer_end_mention,
+        )
+
+    def extend_state(state, i, e, sent_orig):
+        num_special, pointer, in_entity, pointer_start, pointer_end_mention = state
+
+        if e in special_tokens:
+            num_special += 1
+            if e == codes["start_mention_token"]:
+                pointer_start = i
+            elif e == codes["end_mention_token"]:
+                pointer_end_mention = i
+
+        if pointer is None:
+            pass
+        elif in_entity:
+            in_entity = e != codes["end_entity_token"]
+        elif pointer < len(sent_orig) and e == sent_orig[pointer]:
+            pointer += 1
+        elif e == codes["start_mention_token"] or e == codes["end_mention_token"]:
+            pass
+        elif e == codes["start_entity_token"]:
+            in_entity = True
+        else:
+            pointer = None
+
+        return num_special, pointer, in_entity, pointer_start, pointer_end_mention
+
     def get_status(sent):
         c = [
             codes[e]
@@ -169,13 +330,13 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
         else:
             return "e"
 
-    def get_trie_outside(sent, sent_orig):
-        pointer_end = get_pointer_end(sent, sent_orig)
-
+    def get_trie_outside(batch_id, sent_orig, pointer_end):
         if pointer_end:
-            if sent_orig[pointer_end] != codes["EOS"] and sent_orig[
-                pointer_end
-            ] in mention_trie.get([]):
+            if sent_orig[pointer_end] != codes["EOS"] and (
+                pointer_end in mention_ends[batch_id]
+                if mention_ends is not None
+                else sent_orig[pointer_end] in mention_trie.get([])
+            ):
                 return [sent_orig[pointer_end], codes["start_mention_token"]]
             else:
                 return [sent_orig[pointer_end]]
@@ -204,16 +365,26 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
 
         return j if j != len(sent_orig) else None
 
-    def get_trie_mention(sent, sent_orig):
+    def get_trie_mention(batch_id, sent, sent_orig, pointer_start, pointer_end):
+
+        if mention_ends is not None:
+            if not pointer_end:
+                return []
+            ends = mention_ends[batch_id].get(
+                pointer_end - (len(sent) - pointer_start - 1), ()
+            )
+            trie_out = []
+            if any(e > pointer_end for e in ends):
+                trie_out.append(sent_orig[pointer_end])
+            if pointer_end in ends:
+                trie_out.append(codes["end_mention_token"])
+            return trie_out
 
-        pointer_start, _ = get_pointer_mention(sent)
         if pointer_start + 1 < len(sent):
             ment_next = mention_trie.get(sent[pointer_start + 1 :])
         else:
             ment_next = mention_trie.get([])
 
-        pointer_end = get_pointer_end(sent, sent_orig)
-
         if pointer_end:
             if sent_orig[pointer_end] != codes["EOS"]:
                 if sent_orig[pointer_end] in ment_next:
@@ -240,28 +411,38 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
 
         return pointer_start, pointer_end
 
-    def get_trie_entity(sent, sent_orig):
-        pointer_start, pointer_end = get_pointer_mention(sent)
-
+    def get_trie_entity(sent, pointer_start, pointer_end):
         if pointer_start + 1 != pointer_end:
-            mention = decode_fn(sent[pointer_start + 1 : pointer_end]).strip()
 
             if candidates_trie is not None:
                 candidates_trie_tmp = candidates_trie
             elif mention_to_candidates_dict is not None:
-                candidates_trie_tmp = Trie(
-                    [
-                        encode_fn(
-                            " {} {} {} {}".format(
-                                end_mention_token,
-                                start_entity_token,
-                                e,
-                                end_entity_token,
-                            )
-                        )[1:]
-                        for e in mention_to_candidates_dict.get(mention, ["NIL"])
-                    ]
+                if mention_ids_keys:
+                    mention = tuple(sent[pointer_start + 1 : pointer_end])
+                else:
+                    mention = decode_fn(sent[pointer_start + 1 : pointer_end]).strip()
+                candidates_trie_tmp = candidates_trie_cache.get(mention)
+                if candidates_trie_tmp is None:
+                    candidates_trie_tmp = Trie(
+                        [
+                            encode_fn(
+                                " {} {} {} {}".format(
+                                    end_mention_token,
+                                    start_entity_token,
+                                    e,
+                                    end_entity_token,
+                                )
+                            )[1:]
+                            for e in mention_to_candidates_dict.get(mention, ["NIL"])
+                        ]
+                    )
+                    candidates_trie_cache.put(mention, candidates_trie_tmp)
+            elif candidates_bundle is not None:
+                candidates_trie_tmp = candidates_bundle.get(
+                    sent[pointer_start + 1 : pointer_end]
                 )
+                if candidates_trie_tmp is None:
+                    return []
             else:
                 raise RuntimeError()
 
@@ -269,9 +450,485 @@ def _get_end_to_end_prefix_allowed_tokens_fn(
 
         return []
 
+    if stats is not None:
+        get_allowed_tokens_without_stats = get_allowed_tokens
+
+        def get_allowed_tokens(batch_id, sent):
+            start = time.perf_counter()
+            trie_out = get_allowed_tokens_without_stats(batch_id, sent)
+            elapsed = time.perf_counter() - start
+
+            # the status is read again outside of the timed call
+            if not isinstance(sent, list):
+                sent = sent.tolist()
+            stats.record(
+                get_state(batch_id, sent)[0] if incremental else get_status(sent),
+                elapsed,
+                1 if isinstance(trie_out, int) else len(trie_out),
+            )
+            return trie_out
+
+    # lets batched callers get `TokenBitset`s instead of full vocabulary lists,
+    # and decoding drivers read the decoding state and the source tokens
+    prefix_allowed_tokens_fn.get_allowed_tokens = get_allowed_tokens
+    prefix_allowed_tokens_fn.get_state = get_state
+    prefix_allowed_tokens_fn.sent_origs = sent_origs
+    prefix_allowed_tokens_fn.codes = codes
+    prefix_allowed_tokens_fn.decode_fn = decode_fn
+    prefix_allowed_tokens_fn.stats = stats
+
+    return prefix_allowed_tokens_fn
+
+
+def get_multilingual_prefix_allowed_tokens_fn_hf(
+    model, sentences: List[str], langs: List[str], trie_registry, **kwargs
+):
+    # one prefix allowed tokens function per language, with the tries of the
+    # `TrieRegistry`, behind a single one for the whole (mixed) batch
+    routes = [None] * len(sentences)
+    fns = {}
+    for lang in sorted(set(langs)):
+        indices = [i for i, e in enumerate(langs) if e == lang]
+        fns[lang] = get_end_to_end_prefix_allowed_tokens_fn_hf(
+            model,
+            [sentences[i] for i in indices],
+            **dict(kwargs, **trie_registry.get(lang)),
+        )
+        for local_batch_id, batch_id in enumerate(indices):
+            routes[batch_id] = (fns[lang], local_batch_id)
+
+    def prefix_allowed_tokens_fn(batch_id, sent):
+        fn, local_batch_id = routes[batch_id]
+        return fn(local_batch_id, sent)
+
+    for name in ("get_allowed_tokens", "get_state"):
+        setattr(
+            prefix_allowed_tokens_fn,
+            name,
+            lambda batch_id, sent, name=name: getattr(routes[batch_id][0], name)(
+                routes[batch_id][1], sent
+            ),
+        )
+
+    prefix_allowed_tokens_fn.sent_origs = [
+        fn.sent_origs[local_batch_id] for fn, local_batch_id in routes
+    ]
+    # the tokenizer, hence the codes, is the same for every language
+    prefix_allowed_tokens_fn.codes = routes[0][0].codes if routes else {}
+    prefix_allowed_tokens_fn.decode_fn = lambda x: model.tokenizer.decode(
+        torch.tensor(x)
+    )
+    prefix_allowed_tokens_fn.stats = kwargs.get("stats")
+
     return prefix_allowed_tokens_fn
 
 
+def get_mention_ids_to_candidates_dict(mention_to_candidates_dict, encode_fn):
+    # the mention is encoded as it appears inside a sentence (after a space) and
+    # at its beginning, candidates of mentions with the same ids are merged
+    mention_ids_to_candidates_dict = {}
+    for mention, candidates in mention_to_candidates_dict.items():
+        for variant in (" {}".format(mention.strip()), mention.strip()):
+            candidates_tmp = mention_ids_to_candidates_dict.setdefault(
+                tuple(encode_fn(variant)[1:-1]), []
+            )
+            candidates_tmp += [e for e in candidates if e not in candidates_tmp]
+    return mention_ids_to_candidates_dict
+
+
+@lru_cache(maxsize=None)
+def _get_dummy_trie_mention(vocabulary_length, bos_token_id, pad_token_id):
+    return DummyTrieMention(
+        TokenBitset(vocabulary_length, (bos_token_id, pad_token_id))
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_dummy_trie_entity(vocabulary_length, bos_token_id, pad_token_id, codes):
+    return DummyTrieEntity(
+        TokenBitset(vocabulary_length, (bos_token_id, pad_token_id)), dict(codes)
+    )
+
+
+class LRUCache(object):
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        else:
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ConstraintStats(object):
+    # counters of `prefix_allowed_tokens_fn` by status ("o"utside, "m"ention,
+    # "e"ntity); latencies and allowed-set sizes are kept as histograms with
+    # power of two buckets (microseconds and tokens)
+    def __init__(self, num_buckets: int = 32):
+        self.num_buckets = num_buckets
+        self.sampling = False
+        self.clear()
+
+    def clear(self):
+        self.calls = {e: 0 for e in "ome"}
+        self.time = {e: 0.0 for e in "ome"}
+        self.latency_histogram = {e: [0] * self.num_buckets for e in "ome"}
+        self.allowed_histogram = {e: [0] * self.num_buckets for e in "ome"}
+        self.allowed_tokens = {e: 0 for e in "ome"}
+        self.trie_lookups = {"mention": 0, "candidates": 0}
+        self.candidates_trie_builds = 0
+        self.samples = 0
+        self.sample_time = 0.0
+
+    def record(self, status, elapsed, num_allowed):
+        self.calls[status] += 1
+        self.time[status] += elapsed
+        self.latency_histogram[status][
+            min(int(elapsed * 1e6).bit_length(), self.num_buckets - 1)
+        ] += 1
+        self.allowed_histogram[status][
+            min(num_allowed.bit_length(), self.num_buckets - 1)
+        ] += 1
+        self.allowed_tokens[status] += num_allowed
+
+    def record_sample(self, elapsed):
+        self.samples += 1
+        self.sample_time += elapsed
+
+    def get_latency_percentile(self, q, status=None):
+        # upper bound of the bucket, in seconds
+        histogram = [
+            sum(e)
+            for e in zip(
+                *(
+                    self.latency_histogram[e]
+                    for e in (status if status is not None else "ome")
+                )
+            )
+        ]
+        count = 0
+        for i, e in enumerate(histogram):
+            count += e
+            if count and count >= q * sum(histogram):
+                return (1 << i) / 1e6
+        return 0.0
+
+    @property
+    def constraint_time(self):
+        return sum(self.time.values())
+
+    @property
+    def constraint_fraction(self):
+        # share of the `sample` time spent in the callback
+        return self.constraint_time / self.sample_time if self.sample_time else 0
+
+    def to_dict(self):
+        return {
+            "calls": dict(self.calls),
+            "time": dict(self.time),
+            "latency_histogram": {
+                k: list(v) for k, v in self.latency_histogram.items()
+            },
+            "allowed_histogram": {
+                k: list(v) for k, v in self.allowed_histogram.items()
+            },
+            "mean_allowed_tokens": {
+                k: v / self.calls[k] if self.calls[k] else 0
+                for k, v in self.allowed_tokens.items()
+            },
+            "trie_lookups": dict(self.trie_lookups),
+            "candidates_trie_builds": self.candidates_trie_builds,
+            "samples": self.samples,
+            "sample_time": self.sample_time,
+            "constraint_fraction": self.constraint_fraction,
+        }
+
+    def __repr__(self):
+        return (
+            "ConstraintStats(calls={}, constraint_time={:.3f}s, sample_time={:.3f}s, "
+            "p50={:.0f}us, p99={:.0f}us, trie_lookups={}, candidates_trie_builds={})"
+        ).format(
+            self.calls,
+            self.constraint_time,
+            self.sample_time,
+            self.get_latency_percentile(0.5) * 1e6,
+            self.get_latency_percentile(0.99) * 1e6,
+            self.trie_lookups,
+            self.candidates_trie_builds,
+        )
+
+
+class _CountingTrie(object):
+    # counts the lookups into `stats.trie_lookups[name]`, only wrapped around
+    # the tries when stats are collected
+    def __init__(self, trie, stats, name):
+        self.trie = trie
+        self.stats = stats
+        self.name = name
+
+    def get(self, *args):
+        self.stats.trie_lookups[self.name] += 1
+        return self.trie.get(*args)
+
+
+class _CountingCandidatesTrieCache(object):
+    # every entity step looks up the cache once, and builds (and puts) the
+    # candidates trie of the mention on a miss
+    def __init__(self, cache, stats):
+        self.cache = cache
+        self.stats = stats
+
+    def get(self, key, default=None):
+        self.stats.trie_lookups["candidates"] += 1
+        return self.cache.get(key, default)
+
+    def put(self, key, value):
+        self.stats.candidates_trie_builds += 1
+        self.cache.put(key, value)
+
+
+def _get_content_fingerprint(items):
+    # sum of the hashes of the items, so that the insertion order of tries and
+    # dicts does not matter
+    total = 0
+    for item in items:
+        total += int.from_bytes(
+            hashlib.sha1(repr(item).encode("utf-8")).digest(), "big"
+        )
+    return total % (1 << 160)
+
+
+def get_fingerprint(*values):
+    # files (model checkpoints, saved tries), and tries loaded from one, are
+    # fingerprinted by path, size and modification time, other tries and dicts
+    # by their content, plain values by their `repr`
+    fingerprint = hashlib.sha1()
+    for value in values:
+        source = getattr(value, "_source", None)
+        if source is not None and source[0] == "file" and not value._pending:
+            value = source[1]
+
+        if isinstance(value, str) and os.path.isfile(value):
+            value = (value, os.path.getsize(value), os.path.getmtime(value))
+        elif isinstance(value, (Trie, MarisaTrie, ArrayTrie)):
+            value = (type(value).__name__, _get_content_fingerprint(value))
+        elif isinstance(value, dict):
+            value = ("dict", _get_content_fingerprint(value.items()))
+        elif type(value).__repr__ is object.__repr__:
+            # the default `repr` is an address, different in every process
+            raise TypeError(
+                "cannot fingerprint a {}, pass the path it was loaded from".format(
+                    type(value).__name__
+                )
+            )
+        fingerprint.update(repr(value).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+class EntitySpansCache(object):
+    def __init__(
+        self,
+        path: str = None,
+        fingerprint: str = "",
+        maxsize: int = 100000,
+        max_disk_size: int = 1 << 30,
+        commit_every: int = 100,
+        commit_interval: float = 1.0,
+    ):
+        # results are stored for the whitespace normalized sentence, with spans
+        # relative to it, and mapped back to the offsets of every new input.
+        # Disk writes (new entries and access times, memory hits included) are
+        # committed every `commit_every` writes or `commit_interval` seconds
+        self.fingerprint = fingerprint
+        self.max_disk_size = max_disk_size
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.memory = LRUCache(maxsize)
+        self.disk_hits = 0
+        self.disk_size = 0
+        self._accesses = {}
+        self._num_writes = 0
+        self._last_commit = time.time()
+
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entity_spans "
+                "(key TEXT PRIMARY KEY, spans TEXT, size INTEGER, access REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS entity_spans_access "
+                "ON entity_spans (access)"
+            )
+            self.connection.commit()
+            self.disk_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entity_spans"
+            ).fetchone()[0]
+
+    def get(self, sentence: str):
+        key, offsets = self._get_key(sentence)
+        spans = self.memory.get(key)
+        if spans is None and self.connection is not None:
+            row = self.connection.execute(
+                "SELECT spans FROM entity_spans WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                spans = [tuple(e) for e in json.loads(row[0])]
+                self.memory.put(key, spans)
+                self.memory.misses -= 1
+                self.disk_hits += 1
+
+        if spans is None:
+            return None
+
+        # hot entries are served from memory, but must not be evicted from disk
+        if self.connection is not None:
+            self._accesses[key] = time.time()
+            self._write()
+
+        return [
+            (offsets[start], offsets[start + length - 1] + 1 - offsets[start], title)
+            for start, length, title in spans
+        ]
+
+    def put(self, sentence: str, entity_spans):
+        key, offsets = self._get_key(sentence)
+        positions = {offset: i for i, offset in enumerate(offsets)}
+        spans = [
+            (
+                positions[start],
+                positions[start + length - 1] + 1 - positions[start],
+                title,
+            )
+            for start, length, title in entity_spans
+            if start in positions and start + length - 1 in positions
+        ]
+        self.memory.put(key, spans)
+
+        if self.connection is not None:
+            value = json.dumps(spans)
+            size = len(key) + len(value)
+            row = self.connection.execute(
+                "SELECT size FROM entity_spans WHERE key = ?", (key,)
+            ).fetchone()
+            self.disk_size += size - (row[0] if row else 0)
+            self.connection.execute(
+                "REPLACE INTO entity_spans VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._accesses.pop(key, None)
+            self._evict()
+            self._write()
+
+    def flush(self):
+        # writes the pending access times and commits
+        if self.connection is not None:
+            self._write_accesses()
+            self.connection.commit()
+        self._num_writes = 0
+        self._last_commit = time.time()
+
+    def clear(self):
+        self.memory.clear()
+        self.disk_hits = 0
+        self._accesses = {}
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM entity_spans")
+            self.connection.commit()
+            self.disk_size = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    @property
+    def hits(self):
+        return self.memory.hits + self.disk_hits
+
+    @property
+    def misses(self):
+        return self.memory.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+
+    def _get_key(self, sentence: str):
+        offsets = []
+        for match in re.finditer(r"\S+", sentence):
+            if offsets:
+                offsets.append(offsets[-1] + 1)
+            offsets += range(match.start(), match.end())
+        normalized = " ".join(sentence.split())
+        return "{}\t{}".format(self.fingerprint, normalized), offsets
+
+    def _write(self):
+        self._num_writes += 1
+        if (
+            self._num_writes >= self.commit_every
+            or time.time() - self._last_commit >= self.commit_interval
+        ):
+            self.flush()
+
+    def _write_accesses(self):
+        if self._accesses:
+            self.connection.executemany(
+                "UPDATE entity_spans SET access = ? WHERE key = ?",
+                [(access, key) for key, access in self._accesses.items()],
+            )
+            self._accesses = {}
+
+    def _evict(self):
+        # least recently accessed entries first, until the table fits again
+        if self.disk_size <= self.max_disk_size:
+            return
+        self._write_accesses()
+        while self.disk_size > self.max_disk_size:
+            rows = self.connection.execute(
+                "SELECT key, size FROM entity_spans ORDER BY access LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.disk_size <= self.max_disk_size:
+                    break
+                self.connection.execute(
+                    "DELETE FROM entity_spans WHERE key = ?", (key,)
+                )
+                self.disk_size -= size
+
+
 def chunk_it(seq, num):
     assert num > 0
     chunk_len = len(seq) // num
@@ -296,6 +953,148 @@ def batch_it(seq, num=1):
         yield out
 
 
+def constrained_beam_search(
+    decoder_step,
+    batch_id,
+    prefix_allowed_tokens_fn,
+    decoder_start_token_id,
+    eos_token_id,
+    num_beams=5,
+    num_return_sequences=5,
+    score_margin=float("inf"),
+    max_length=1024,
+    length_penalty=1.0,
+    early_stopping=False,
+):
+    # beam search over `decoder_step(tokens, beam_idx)`, which feeds the last
+    # token of every beam after reordering its cache with the indices of their
+    # parents (`None` at the first step) and returns the next token log-probs.
+    # As in `generate`, the best `2 * num_beams` continuations are ranked: the
+    # ones in the first `num_beams` that end (EOS or `max_length`) are finished
+    # and the best `num_beams` of those that do not end go on. Hypotheses
+    # falling more than `score_margin` behind the best one are dropped: on easy
+    # inputs the beam shrinks to a single hypothesis.
+    # `early_stopping` has the semantics of `generate`: `True` stops with
+    # `num_beams` finished hypotheses, `False` when the best live beam scored
+    # at its current length cannot beat them, and "never" when it cannot at
+    # `max_length` either (the exact bound for `length_penalty > 0`)
+    beams = [([decoder_start_token_id], 0.0)]
+    beam_idx = None
+    finished = []
+    while beams:
+        log_probs = decoder_step([sent[-1] for sent, _ in beams], beam_idx)
+
+        candidates = []
+        for i, (sent, score) in enumerate(beams):
+            allowed = prefix_allowed_tokens_fn(batch_id, sent)
+            if isinstance(allowed, int):
+                allowed = [allowed]
+            if len(allowed) == 0:
+                continue
+            top = log_probs[i, allowed].topk(min(2 * num_beams, len(allowed)))
+            candidates += [
+                (score + value, i, allowed[j])
+                for value, j in zip(top.values.tolist(), top.indices.tolist())
+            ]
+
+        next_beams = []
+        beam_idx = []
+        for rank, (score, i, token) in enumerate(
+            sorted(candidates, reverse=True)[: 2 * num_beams]
+        ):
+            sent = beams[i][0] + [token]
+            if token == eos_token_id or len(sent) >= max_length:
+                # the length does not count the decoder start token
+                if rank < num_beams:
+                    finished.append((score / (len(sent) - 1) ** length_penalty, sent))
+            elif len(next_beams) < num_beams:
+                next_beams.append((sent, score))
+                beam_idx.append(i)
+        finished = sorted(finished, reverse=True)[:num_beams]
+
+        if next_beams:
+            best = next_beams[0][1]
+            keep = [
+                k
+                for k, (_, score) in enumerate(next_beams)
+                if score >= best - score_margin
+            ]
+            next_beams = [next_beams[k] for k in keep]
+            beam_idx = [beam_idx[k] for k in keep]
+
+            # no live hypothesis can still beat the finished ones
+            if len(finished) >= num_beams:
+                if early_stopping == "never" and length_penalty > 0:
+                    length = max_length - 1
+                else:
+                    length = len(next_beams[0][0]) - 1
+                if (
+                    early_stopping is True
+                    or best / length**length_penalty <= finished[-1][0]
+                ):
+                    next_beams = []
+
+        beams = next_beams
+
+    if not finished:
+        finished = [(-float("inf"), [decoder_start_token_id])]
+
+    return finished[:num_return_sequences]
+
+
+def get_length_buckets(lengths, max_tokens=4096):
+    # indices sorted by length and grouped so that every bucket, once padded
+    # to its longest element, has at most `max_tokens` tokens
+    buckets = []
+    bucket = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if bucket and lengths[i] * (len(bucket) + 1) > max_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+
+    if bucket:
+        buckets.append(bucket)
+
+    return buckets
+
+
+def get_padding_efficiency(lengths, buckets):
+    padded = sum(len(bucket) * max(lengths[i] for i in bucket) for bucket in buckets)
+    return sum(lengths) / padded if padded else 1.0
+
+
+def get_bucket_prefix_allowed_tokens_fn(prefix_allowed_tokens_fn, indices):
+    # maps the batch ids of a bucket back to the ones of the whole input
+    def bucket_prefix_allowed_tokens_fn(batch_id, sent):
+        return prefix_allowed_tokens_fn(indices[batch_id], sent)
+
+    for name in ("get_allowed_tokens", "get_state"):
+        if hasattr(prefix_allowed_tokens_fn, name):
+            setattr(
+                bucket_prefix_allowed_tokens_fn,
+                name,
+                lambda batch_id, sent, fn=getattr(prefix_allowed_tokens_fn, name): fn(
+                    indices[batch_id], sent
+                ),
+            )
+
+    if hasattr(prefix_allowed_tokens_fn, "sent_origs"):
+        bucket_prefix_allowed_tokens_fn.sent_origs = [
+            prefix_allowed_tokens_fn.sent_origs[i] for i in indices
+        ]
+
+    for name in ("codes", "decode_fn"):
+        if hasattr(prefix_allowed_tokens_fn, name):
+            setattr(
+                bucket_prefix_allowed_tokens_fn,
+                name,
+                getattr(prefix_allowed_tokens_fn, name),
+            )
+
+    return bucket_prefix_allowed_tokens_fn
+
+
 def create_input(doc, max_length, start_delimiter, end_delimiter):
     if "meta" in doc and all(
         e in doc["meta"] for e in ("left_context", "mention", "right_context")
@@ -380,13 +1179,34 @@ def get_entity_spans_post_processing(sentences):
 
 
 def _get_entity_spans(
-    model, input_sentences, prefix_allowed_tokens_fn, redirections=None,
+    model,
+    input_sentences,
+    prefix_allowed_tokens_fn,
+    redirections=None,
+    align_tokens=False,
+    **kwargs,
 ):
     output_sentences = model.sample(
         get_entity_spans_pre_processing(input_sentences),
         prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+        **kwargs,
     )
 
+    if align_tokens:
+        return get_entity_spans_from_tokens(
+            input_sentences,
+            [e[0]["tokens"] for e in output_sentences],
+            prefix_allowed_tokens_fn.sent_origs,
+            get_input_offset_mappings(
+                input_sentences,
+                prefix_allowed_tokens_fn,
+                tokenizer=getattr(model, "tokenizer", None),
+            ),
+            prefix_allowed_tokens_fn.codes,
+            prefix_allowed_tokens_fn.decode_fn,
+            redirections=redirections,
+        )
+
     output_sentences = get_entity_spans_post_processing(
         [e[0]["text"] for e in output_sentences]
     )
@@ -396,6 +1216,32 @@ def _get_entity_spans(
     )
 
 
+def _get_cached_entity_spans(entity_spans_cache, input_sentences, get_entity_spans_fn):
+    if entity_spans_cache is None:
+        return get_entity_spans_fn(input_sentences)
+
+    outputs = [entity_spans_cache.get(sent) for sent in input_sentences]
+
+    # only the first of every group of equal (normalized) sentences is decoded
+    missing = {}
+    for i, (sent, output) in enumerate(zip(input_sentences, outputs)):
+        if output is None:
+            missing.setdefault(entity_spans_cache._get_key(sent)[0], []).append(i)
+
+    if missing:
+        indices = [e[0] for e in missing.values()]
+        for i, entity_spans in zip(
+            indices, get_entity_spans_fn([input_sentences[i] for i in indices])
+        ):
+            entity_spans_cache.put(input_sentences[i], entity_spans)
+            outputs[i] = entity_spans
+
+        for i in (i for e in missing.values() for i in e[1:]):
+            outputs[i] = entity_spans_cache.get(input_sentences[i])
+
+    return outputs
+
+
 def get_entity_spans_fairseq(
     model,
     input_sentences,
@@ -403,18 +1249,35 @@ def get_entity_spans_fairseq(
     candidates_trie=None,
     mention_to_candidates_dict=None,
     redirections=None,
+    incremental=False,
+    candidates_trie_cache=None,
+    candidates_bundle=None,
+    mention_automaton=None,
+    entity_spans_cache=None,
+    align_tokens=False,
+    constraint_stats=None,
 ):
-    return _get_entity_spans(
-        model,
+    return _get_cached_entity_spans(
+        entity_spans_cache,
         input_sentences,
-        prefix_allowed_tokens_fn=get_end_to_end_prefix_allowed_tokens_fn_fairseq(
+        lambda input_sentences: _get_entity_spans(
             model,
-            get_entity_spans_pre_processing(input_sentences),
-            mention_trie=mention_trie,
-            candidates_trie=candidates_trie,
-            mention_to_candidates_dict=mention_to_candidates_dict,
+            input_sentences,
+            prefix_allowed_tokens_fn=get_end_to_end_prefix_allowed_tokens_fn_fairseq(
+                model,
+                get_entity_spans_pre_processing(input_sentences),
+                mention_trie=mention_trie,
+                candidates_trie=candidates_trie,
+                mention_to_candidates_dict=mention_to_candidates_dict,
+                incremental=incremental,
+                candidates_trie_cache=candidates_trie_cache,
+                candidates_bundle=candidates_bundle,
+                mention_automaton=mention_automaton,
+                stats=constraint_stats,
+            ),
+            redirections=redirections,
+            align_tokens=align_tokens,
         ),
-        redirections=redirections,
     )
 
 
@@ -425,18 +1288,176 @@ def get_entity_spans_hf(
     candidates_trie=None,
     mention_to_candidates_dict=None,
     redirections=None,
+    incremental=False,
+    candidates_trie_cache=None,
+    candidates_bundle=None,
+    mention_automaton=None,
+    batched_constraints=False,
+    max_tokens=None,
+    entity_spans_cache=None,
+    align_tokens=False,
+    constraint_stats=None,
+):
+    return _get_cached_entity_spans(
+        entity_spans_cache,
+        input_sentences,
+        lambda input_sentences: _get_entity_spans(
+            model,
+            input_sentences,
+            prefix_allowed_tokens_fn=get_end_to_end_prefix_allowed_tokens_fn_hf(
+                model,
+                get_entity_spans_pre_processing(input_sentences),
+                mention_trie=mention_trie,
+                candidates_trie=candidates_trie,
+                mention_to_candidates_dict=mention_to_candidates_dict,
+                incremental=incremental,
+                candidates_trie_cache=candidates_trie_cache,
+                candidates_bundle=candidates_bundle,
+                mention_automaton=mention_automaton,
+                stats=constraint_stats,
+            ),
+            redirections=redirections,
+            batched_constraints=batched_constraints,
+            max_tokens=max_tokens,
+            align_tokens=align_tokens,
+        ),
+    )
+
+
+def get_multilingual_entity_spans_hf(
+    model,
+    input_sentences,
+    langs,
+    trie_registry,
+    redirections=None,
+    incremental=False,
+    candidates_trie_cache=None,
+    batched_constraints=False,
+    max_tokens=None,
+    align_tokens=False,
+    constraint_stats=None,
 ):
     return _get_entity_spans(
         model,
         input_sentences,
-        prefix_allowed_tokens_fn=get_end_to_end_prefix_allowed_tokens_fn_hf(
+        prefix_allowed_tokens_fn=get_multilingual_prefix_allowed_tokens_fn_hf(
             model,
             get_entity_spans_pre_processing(input_sentences),
-            mention_trie=mention_trie,
-            candidates_trie=candidates_trie,
-            mention_to_candidates_dict=mention_to_candidates_dict,
+            langs,
+            trie_registry,
+            incremental=incremental,
+            candidates_trie_cache=candidates_trie_cache,
+            stats=constraint_stats,
         ),
         redirections=redirections,
+        batched_constraints=batched_constraints,
+        max_tokens=max_tokens,
+        align_tokens=align_tokens,
+    )
+
+
+def get_document_windows(document, window_size=128, overlap=32):
+    # splits a document in windows of `window_size` words, consecutive windows
+    # sharing `overlap` words; every window owns the characters from the middle
+    # of its overlap with the previous window to the middle of the next one
+    words = [(m.start(), m.end()) for m in re.finditer(r"\S+", document)]
+    if not words:
+        return []
+
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + window_size, len(words))
+        bounds.append((start, end))
+        if end == len(words):
+            break
+        start = max(end - overlap, start + 1)
+
+    windows = []
+    for k, (start, end) in enumerate(bounds):
+        windows.append(
+            (
+                words[start][0],
+                words[end - 1][1],
+                words[(start + bounds[k - 1][1]) // 2][0] if k > 0 else 0,
+                (
+                    words[(bounds[k + 1][0] + end) // 2][0]
+                    if k + 1 < len(bounds)
+                    else len(document)
+                ),
+            )
+        )
+    return windows
+
+
+def _get_document_entity_spans(
+    get_entity_spans_fn,
+    model,
+    documents,
+    window_size=128,
+    overlap=32,
+    batch_size=32,
+    **kwargs,
+):
+    windows = [
+        (i, window)
+        for i, document in enumerate(documents)
+        for window in get_document_windows(document, window_size, overlap)
+    ]
+
+    # windows of all the documents are decoded together, `batch_size` at a time
+    entity_spans = [[] for _ in documents]
+    for batch in batch_it(windows, batch_size):
+        batch_spans = get_entity_spans_fn(
+            model,
+            [documents[i][start:end] for i, (start, end, _, _) in batch],
+            **kwargs,
+        )
+        for (i, (start, _, core_start, core_end)), spans in zip(batch, batch_spans):
+            entity_spans[i] += [
+                (start + span_start, span_length, title)
+                for span_start, span_length, title in spans
+                if core_start <= start + span_start < core_end
+            ]
+
+    # a mention crossing the border of two cores can still be found twice
+    for i, spans in enumerate(entity_spans):
+        entity_spans[i] = []
+        for span in sorted(spans):
+            if entity_spans[i] and span[0] < sum(entity_spans[i][-1][:2]):
+                if span[1] > entity_spans[i][-1][1]:
+                    entity_spans[i][-1] = span
+            else:
+                entity_spans[i].append(span)
+
+    return entity_spans
+
+
+def get_document_entity_spans_fairseq(
+    model, documents, window_size=128, overlap=32, batch_size=32, **kwargs
+):
+    return _get_document_entity_spans(
+        get_entity_spans_fairseq,
+        model,
+        documents,
+        window_size=window_size,
+        overlap=overlap,
+        batch_size=batch_size,
+        **kwargs,
+    )
+
+
+def get_document_entity_spans_hf(
+    model, documents, window_size=128, overlap=32, batch_size=32, **kwargs
+):
+    return _get_document_entity_spans(
+        get_entity_spans_hf,
+        model,
+        documents,
+        window_size=window_size,
+        overlap=overlap,
+        batch_size=batch_size,
+        **kwargs,
     )
 
 
@@ -513,6 +1534,194 @@ def get_entity_spans_finalize(input_sentences, output_sentences, redirections=No
     return return_outputs
 
 
+def get_offset_mapping(sentence, token_ids, decode_fn, max_skip=8, max_pieces=16):
+    # character offsets of every token in `sentence`, matching the decoded tokens
+    # left to right. Byte-level pieces of a multi-byte character decode to
+    # U+FFFD alone: they are decoded together with the next tokens until the
+    # characters are whole, and all get their span. Tokens that cannot be
+    # matched (special tokens) get an empty span at the current position
+    offsets = []
+    cursor = 0
+    i = 0
+    while i < len(token_ids):
+        j = i + 1
+        piece = decode_fn(token_ids[i:j])
+        while "\ufffd" in piece and j < min(len(token_ids), i + max_pieces):
+            j += 1
+            piece = decode_fn(token_ids[i:j])
+        piece = piece.strip()
+
+        start = (
+            sentence.find(piece, cursor, cursor + len(piece) + max_skip)
+            if piece
+            else -1
+        )
+        if start < 0:
+            offsets += [(cursor, cursor)] * (j - i)
+        else:
+            cursor = start + len(piece)
+            offsets += [(start, cursor)] * (j - i)
+        i = j
+    return offsets
+
+
+def get_input_offset_mappings(
+    input_sentences, prefix_allowed_tokens_fn, tokenizer=None
+):
+    # offsets are found in the pre-processed sentences, which only add a leading
+    # space and replace characters one by one. Fast tokenizers give them
+    # directly, when they encode the sentences as the source
+    sentences = get_entity_spans_pre_processing(input_sentences)
+    encodings = None
+    if getattr(tokenizer, "is_fast", False):
+        encodings = tokenizer(sentences, return_offsets_mapping=True)
+
+    offset_mappings = []
+    for i, (sent, sent_orig) in enumerate(
+        zip(sentences, prefix_allowed_tokens_fn.sent_origs)
+    ):
+        if encodings is not None and list(encodings["input_ids"][i][1:]) == list(
+            sent_orig[1:]
+        ):
+            offsets = encodings["offset_mapping"][i]
+        else:
+            offsets = get_offset_mapping(
+                sent, sent_orig, prefix_allowed_tokens_fn.decode_fn
+            )
+        offset_mappings.append(
+            [(max(start - 1, 0), max(end - 1, 0)) for start, end in offsets]
+        )
+    return offset_mappings
+
+
+def _align_entity_spans_vectorized(output_sequences, source_sequences, codes):
+    # outputs are copies of their source with `{ mention } [ title ]` inserted:
+    # everything outside of `[ title ]` that is not `{` or `}` must be the next
+    # source token. Checked for the whole batch at once; `None` for the outputs
+    # where this does not hold
+    width = max(len(e) for e in output_sequences + source_sequences)
+    outputs = np.full((len(output_sequences), width), -1, dtype=np.int64)
+    sources = np.full((len(source_sequences), width + 1), -1, dtype=np.int64)
+    for i, (output, source) in enumerate(zip(output_sequences, source_sequences)):
+        outputs[i, : len(output)] = output
+        sources[i, : len(source)] = source
+
+    is_start_mention = outputs == codes["start_mention_token"]
+    is_end_mention = outputs == codes["end_mention_token"]
+    is_start_entity = outputs == codes["start_entity_token"]
+    is_end_entity = outputs == codes["end_entity_token"]
+    in_entity = (
+        np.cumsum(is_start_entity, 1) - np.cumsum(is_end_entity, 1) > 0
+    ) | is_end_entity
+    is_copy = (outputs >= 0) & ~(is_start_mention | is_end_mention | in_entity)
+    pointers = np.cumsum(is_copy, 1)
+    copied = np.take_along_axis(sources, np.maximum(pointers - 1, 0), 1)
+    aligned = np.all(~is_copy | (copied == outputs), 1)
+
+    alignments = []
+    for i, output in enumerate(output_sequences):
+        starts = np.flatnonzero(is_start_mention[i])
+        ends = np.flatnonzero(is_end_mention[i])
+        entity_starts = np.flatnonzero(is_start_entity[i])
+        entity_ends = np.flatnonzero(is_end_entity[i])
+        if not (
+            aligned[i]
+            and len(starts) == len(ends) == len(entity_starts) == len(entity_ends)
+            and np.all(starts < ends)
+            and np.all(ends < entity_starts)
+            and np.all(entity_starts < entity_ends)
+            and np.all(entity_ends[:-1] < starts[1:])
+        ):
+            alignments.append(None)
+            continue
+
+        alignments.append(
+            [
+                (pointers[i, s], pointers[i, e], output[es + 1 : ee])
+                for s, e, es, ee in zip(starts, ends, entity_starts, entity_ends)
+            ]
+        )
+
+    return alignments
+
+
+def _align_entity_spans_sequential(output, source, codes, max_skip=8):
+    # same alignment one token at a time, skipping what does not match: a token
+    # not in the next `max_skip` source tokens is ignored, a mention that is not
+    # closed properly is dropped
+    alignment = []
+    status = "o"
+    pointer = 0
+    for token in output:
+        if status == "e":
+            if token == codes["end_entity_token"]:
+                alignment.append((start, end, title))
+                status = "o"
+            else:
+                title.append(token)
+        elif token == codes["start_mention_token"]:
+            start = pointer
+            status = "m"
+        elif token == codes["end_mention_token"]:
+            if status == "m":
+                end = pointer
+                status = "t"
+        elif token == codes["start_entity_token"]:
+            if status == "t":
+                title = []
+                status = "e"
+        elif token in source[pointer : pointer + max_skip]:
+            pointer += source[pointer : pointer + max_skip].index(token) + 1
+            if status == "t":
+                status = "o"
+
+    return alignment
+
+
+def get_entity_spans_from_tokens(
+    input_sentences,
+    output_sequences,
+    source_sequences,
+    offset_mappings,
+    codes,
+    decode_fn,
+    redirections=None,
+):
+    output_sequences = [list(e) for e in output_sequences]
+    for i, (output, source) in enumerate(zip(output_sequences, source_sequences)):
+        if not output or output[0] != source[0]:
+            output.insert(0, source[0])
+        if codes["EOS"] in output[1:]:
+            del output[output.index(codes["EOS"], 1) + 1 :]
+
+    return_outputs = []
+    for sent, output, source, offsets, alignment in zip(
+        input_sentences,
+        output_sequences,
+        source_sequences,
+        offset_mappings,
+        _align_entity_spans_vectorized(output_sequences, source_sequences, codes),
+    ):
+        if alignment is None:
+            alignment = _align_entity_spans_sequential(output, source, codes)
+
+        entities = []
+        for start, end, title in alignment:
+            if start >= end or end > len(offsets):
+                continue
+            start, end = offsets[start][0], offsets[end - 1][1]
+            title = decode_fn(list(title)).strip().replace(" ", "_")
+            if end <= start or len(title) <= 1 or title == "NIL":
+                continue
+            if redirections is not None and title in redirections:
+                title = redirections[title]
+            entities.append((start, end - start, title))
+
+        return_outputs.append(entities)
+
+    return return_outputs
+
+
 def get_markdown(sentences, entity_spans):
     return_outputs = []
     for sent, entities in zip(sentences, entity_spans):
@@ -640,8 +1849,45 @@ def get_macro_f1(guess_entities, gold_entities, mode="strong"):
     return (sum(all_scores) / len(all_scores)) if len(all_scores) else 0
 
 
-def extract_pages(filename):
-    docs = {}
+# anchors of WikiExtractor paragraphs, any other tag is dropped keeping its text
+# as for html.parser, only a `<` followed by a letter opens a tag: `a < b` is text
+_ANCHOR_RE = re.compile(
+    r"<a(\s[^>]*)?>(.*?)</a\s*>|</?[a-z][^>]*>", re.DOTALL | re.IGNORECASE
+)
+_HREF_RE = re.compile(
+    r"""\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.IGNORECASE
+)
+_TAG_RE = re.compile(r"</?[A-Za-z][^>]*>")
+
+
+def get_paragraph_anchors(line):
+    # the text of a paragraph line and its anchors as (href, start, end), with
+    # the entities unescaped as by `BeautifulSoup(line, "html.parser")`
+    paragraph = []
+    anchors = []
+    length = 0
+    position = 0
+    for match in _ANCHOR_RE.finditer(line):
+        text = html.unescape(line[position : match.start()])
+        paragraph.append(text)
+        length += len(text)
+        position = match.end()
+
+        if match.group(2) is not None:
+            text = html.unescape(_TAG_RE.sub("", match.group(2)))
+            href = _HREF_RE.search(match.group(1) or "")
+            href = href and next(e for e in href.groups() if e is not None)
+            if href:
+                anchors.append((html.unescape(href), length, length + len(text)))
+            paragraph.append(text)
+            length += len(text)
+
+    paragraph.append(html.unescape(line[position:]))
+    return "".join(paragraph), anchors
+
+
+def iter_pages(filename):
+    # documents of a WikiExtractor file, one at a time
     with open(filename) as f:
         for line in f:
             # CASE 1: beginning of the document
@@ -652,36 +1898,31 @@ def extract_pages(filename):
 
             # CASE 2: end of the document
             elif line.startswith("</doc>"):
-                assert doc["id"] not in docs, "{} ({}) already in dict as {}".format(
-                    doc["id"], doc["title"], docs[doc["id"]]["title"]
-                )
-                docs[doc["id"]] = doc
+                yield doc
 
             # CASE 3: in the document
             else:
-                doc["paragraphs"].append("")
-                try:
-                    line = BeautifulSoup(line, "html.parser")
-                except:
-                    print("error line `{}`".format(line))
-                    line = [line]
-
-                for span in line:
-                    if isinstance(span, bs4.element.Tag):
-                        if span.get("href", None):
-                            doc["anchors"].append(
-                                {
-                                    "text": span.get_text(),
-                                    "href": span["href"],
-                                    "paragraph_id": len(doc["paragraphs"]) - 1,
-                                    "start": len(doc["paragraphs"][-1]),
-                                    "end": len(doc["paragraphs"][-1])
-                                    + len(span.get_text()),
-                                }
-                            )
-                        doc["paragraphs"][-1] += span.get_text()
-                    else:
-                        doc["paragraphs"][-1] += str(span)
+                paragraph, anchors = get_paragraph_anchors(line)
+                for href, start, end in anchors:
+                    doc["anchors"].append(
+                        {
+                            "text": paragraph[start:end],
+                            "href": href,
+                            "paragraph_id": len(doc["paragraphs"]),
+                            "start": start,
+                            "end": end,
+                        }
+                    )
+                doc["paragraphs"].append(paragraph)
+
+
+def extract_pages(filename):
+    docs = {}
+    for doc in iter_pages(filename):
+        assert doc["id"] not in docs, "{} ({}) already in dict as {}".format(
+            doc["id"], doc["title"], docs[doc["id"]]["title"]
+        )
+        docs[doc["id"]] = doc
 
     return docs
 
@@ -701,12 +1942,15 @@ def search_simple(anchor, lang, lang_title2wikidataID):
         return False, unquoted
 
 
-def search_wikipedia(title, lang, lang_title2wikidataID, lang_redirect2title):
-
-    max_redirects = 10
-    while (lang, title) in lang_redirect2title and max_redirects > 0:
-        title = lang_redirect2title[(lang, title)]
-        max_redirects -= 1
+def search_wikipedia(
+    title, lang, lang_title2wikidataID, lang_redirect2title, max_redirects=10
+):
+    # a `lang_redirect2title` from `get_redirect_closure` needs a single hop
+    for _ in range(max_redirects):
+        redirect = lang_redirect2title.get((lang, title))
+        if redirect is None:
+            break
+        title = redirect
 
     if (lang, title) in lang_title2wikidataID:
         return True, lang_title2wikidataID[(lang, title)]
@@ -719,14 +1963,19 @@ def search_wikidata(query, label_alias2wikidataID):
 
 
 def get_wikidata_ids(
-    anchor, lang, lang_title2wikidataID, lang_redirect2title, label_or_alias2wikidataID,
+    anchor,
+    lang,
+    lang_title2wikidataID,
+    lang_redirect2title,
+    label_or_alias2wikidataID,
+    max_redirects=10,
 ):
     success, result = search_simple(anchor, lang, label_or_alias2wikidataID)
     if success:
         return result, "simple"
     else:
         success, result = search_wikipedia(
-            result, lang, lang_title2wikidataID, lang_redirect2title
+            result, lang, lang_title2wikidataID, lang_redirect2title, max_redirects
         )
         if success:
             return result, "wikipedia"
@@ -734,6 +1983,75 @@ def get_wikidata_ids(
             return search_wikidata(result, label_or_alias2wikidataID), "wikidata"
 
 
+def get_wikidata_ids_batch(
+    anchors,
+    langs,
+    lang_title2wikidataID,
+    lang_redirect2title,
+    label_or_alias2wikidataID,
+    max_redirects=10,
+):
+    # anchors repeat a lot within a dump, every (anchor, lang) is resolved once
+    results = {}
+    for key in zip(anchors, langs):
+        if key not in results:
+            results[key] = get_wikidata_ids(
+                *key,
+                lang_title2wikidataID,
+                lang_redirect2title,
+                label_or_alias2wikidataID,
+                max_redirects,
+            )
+    return [results[key] for key in zip(anchors, langs)]
+
+
+# files of a wikidata index directory, see `build_wikidata_index.py`
+WIKIDATA_INDEX_FILES = {
+    "lang_title2wikidataID": ("lang_title2wikidataID.marisa", "ids"),
+    "lang_redirect2title": ("lang_redirect2title.marisa", "str"),
+    "label_or_alias2wikidataID": ("label_or_alias2wikidataID.marisa", "ids"),
+}
+
+
+def get_redirect_closure(lang_redirect2title):
+    # every redirect mapped to the end of its chain; redirects that end up in a
+    # cycle have no target and are left out
+    closure = {}
+    for key in lang_redirect2title:
+        path = []
+        on_path = set()
+        current = key
+        while (
+            current in lang_redirect2title
+            and current not in closure
+            and current not in on_path
+        ):
+            path.append(current)
+            on_path.add(current)
+            current = (current[0], lang_redirect2title[current])
+
+        if current in on_path:
+            target = None
+        elif current in closure:
+            target = closure[current]
+        else:
+            target = current[1]
+        for e in path:
+            closure[e] = target
+
+    return {k: v for k, v in closure.items() if v is not None}
+
+
+def load_wikidata_index(path):
+    # the three dictionaries of `get_wikidata_ids` as memory mapped
+    # `MarisaMapping`s, in the order of its arguments; redirects are collapsed
+    # by `get_redirect_closure`, so `max_redirects=1` is enough
+    return tuple(
+        MarisaMapping.load_from_file(os.path.join(path, filename), value_type)
+        for filename, value_type in WIKIDATA_INDEX_FILES.values()
+    )
+
+
 def post_process_wikidata(outputs, text_to_id=False, marginalize=False):
 
     if text_to_id: